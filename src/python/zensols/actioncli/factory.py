@@ -308,6 +308,9 @@ class ConfigChildrenFactory(ConfigFactory):
     separated property child property is set and then passed on to the
     initializer of the object created.
 
+    If the value of a child property is a list (i.e. using ``eval:``) a child is
+    created for each element and the tuple of children is set.
+
     In addition, any parameters passed to the initializer of the instance
     method are passed on the comma separate list ``<name>_pass_param`` where
     ``name`` is the name of the next object to instantiate per the
@@ -332,7 +335,12 @@ class ConfigChildrenFactory(ConfigFactory):
                 passkw = self._process_pass_params(k, kwargs)
                 logger.debug(f'create {k}: {kwargs}')
                 if k in kwargs:
-                    kwargs[k] = self.instance(kwargs[k], **passkw)
+                    v = kwargs[k]
+                    if isinstance(v, (tuple, list)):
+                        kwargs[k] = tuple(
+                            map(lambda n: self.instance(n, **passkw), v))
+                    else:
+                        kwargs[k] = self.instance(v, **passkw)
                     for pk in passkw.keys():
                         del kwargs[pk]
             del kwargs[self.CREATE_CHILDREN_KEY]
@@ -1,24 +1,353 @@
 from abc import ABCMeta, abstractmethod
+from typing import Callable, Set, Dict, List, Tuple
 from dataclasses import dataclass
 import logging
 import math
+import os
+import sys
+import heapq
+import time as tm
+import itertools as it
+from bisect import bisect_right
+import uuid
+import pickle
+import queue
+import threading
+import json
+from pathlib import Path
+from io import StringIO
+from copy import copy
+from collections import OrderedDict
+from contextlib import contextmanager
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import concurrent.futures as futures
 from zensols.actioncli.time import time
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+try:
+    import resource as _resource
+except ImportError:
+    _resource = None
 from zensols.actioncli import (
     Stash,
     Configurable,
     PreemptiveStash,
     StashFactory,
-    chunks,
 )
 
 logger = logging.getLogger(__name__)
 
+# map reducers resident in the worker process by token, which is bounded for
+# long lived pools shared by many reducers
+_WORKER_REDUCERS = OrderedDict()
+_WORKER_REDUCERS_SIZE = 8
+
+# multi-process stashes created once per worker by name
+_WORKER_STASHES = {}
+
+# tokens of the ``ExecutorPool`` instances initialized in this process
+_EXECUTOR_INITIALIZED = set()
+
+
+@dataclass
+class StashCreator(object):
+    """A picklable callable that creates a stash from its section in the
+    configuration using a ``StashFactory``.
+
+    :param config: the configuration with the stash's section
+    :param name: the name of the stash's section (without ``_stash``)
+
+    """
+    config: Configurable
+    name: str
+
+    def __call__(self) -> Stash:
+        return StashFactory(self.config).instance(self.name)
+
+
+def _init_map_worker(token: str, reducer):
+    """Pool initializer that makes ``reducer`` resident in the worker, which
+    creates its stash once per worker.
+
+    """
+    reducer._init_worker()
+    _WORKER_REDUCERS[token] = reducer
+    while len(_WORKER_REDUCERS) > _WORKER_REDUCERS_SIZE:
+        _WORKER_REDUCERS.popitem(last=False)
+
+
+def _worker_reducer(token: str, state):
+    """Return the reducer resident in the worker, first installing it from its
+    pickled ``state`` when the pool was not started by the reducer.  Workers
+    in the parent process (threads) are instead given the reducer itself as
+    ``state``.
+
+    """
+    if isinstance(state, StashMapReducer):
+        return state
+    reducer = _WORKER_REDUCERS.get(token)
+    if reducer is None:
+        _init_map_worker(token, pickle.loads(state))
+        reducer = _WORKER_REDUCERS[token]
+    else:
+        _WORKER_REDUCERS.move_to_end(token)
+    return reducer
+
+
+def _map_worker(task: tuple):
+    """Map a group of keys in the worker with its resident reducer.
+
+    """
+    token, ids, state = task
+    reducer = _worker_reducer(token, state)
+    return reducer._combine(reducer._map_ids(ids))
+
+
+def _map_spill_worker(task: tuple) -> int:
+    """Map a group of keys in the worker and dump the results to the result
+    stash.
+
+    """
+    token, ids, state = task
+    return _worker_reducer(token, state)._map_ids(ids)
+
+
+def _map_reduce_worker(task: tuple):
+    """Map and then reduce a group of keys in the worker.
+
+    """
+    token, ids, state = task
+    reducer = _worker_reducer(token, state)
+    return reducer._reduce(reducer._combine(reducer._map_ids(ids)))
+
+
+def _merge_worker(task: tuple):
+    """Merge reduced values in the worker as one node of the reduction tree.
+
+    """
+    token, vals, state = task
+    return _worker_reducer(token, state)._reduce_final(vals)
+
+
+def _timed_worker(task: tuple) -> tuple:
+    """Invoke a worker function with a key group task and time it for adaptive
+    chunk sizing.
+
+    :param task: the worker function, the index of the key group and the
+                 task given to the function
+    :return: the index, number of keys, seconds taken and result
+
+    """
+    fn, idx, inner = task
+    start = tm.time()
+    res = fn(inner)
+    return (idx, len(inner[1]), tm.time() - start, res)
+
+
+class AdaptiveChunker(object):
+    """Sizes chunks of items so each takes about ``target_duration`` seconds to
+    process.  Chunks start as small probes, and each finished chunk updates a
+    moving average of the per item cost used to size the chunks that follow.
+    Near the end of the data, chunks are limited to an even share of the
+    remaining items across the workers so one large last chunk doesn't leave
+    the others idle.
+
+    """
+    GROWTH = 4
+    """The largest factor a chunk grows over the last, which keeps noisy probe
+    measurements from creating a huge chunk.
+
+    """
+
+    def __init__(self, target_duration: float = 1., n_workers: int = 1,
+                 probe_size: int = 1, max_size: int = None,
+                 smoothing: float = 0.5):
+        """Initialize.
+
+        :param target_duration: the seconds each chunk should take
+        :param n_workers: the number of workers sharing the chunks
+        :param probe_size: the size of the chunks created before any finished
+        :param max_size: the largest chunk size
+        :param smoothing: the weight of the latest chunk in the per item cost
+
+        """
+        self.target_duration = target_duration
+        self.n_workers = max(n_workers, 1)
+        self.probe_size = max(probe_size, 1)
+        self.max_size = max_size
+        self.smoothing = smoothing
+        self.cost = None
+        self.last_size = self.probe_size
+
+    def observe(self, n_items: int, elapsed: float):
+        """Update the per item cost with a finished chunk.
+
+        :param n_items: the number of items in the chunk
+        :param elapsed: the seconds it took to process
+
+        """
+        if n_items > 0:
+            cost = elapsed / n_items
+            if self.cost is None:
+                self.cost = cost
+            else:
+                self.cost = (self.smoothing * cost) + \
+                    ((1 - self.smoothing) * self.cost)
+
+    def next_size(self, n_remaining: int = None) -> int:
+        """Return the size of the next chunk.
+
+        :param n_remaining: the number of items not yet chunked if known
+
+        """
+        if self.cost is None:
+            size = self.probe_size
+        else:
+            size = self.last_size * self.GROWTH
+            if self.cost > 0:
+                size = min(size, int(self.target_duration / self.cost))
+        if n_remaining is not None:
+            size = min(size, math.ceil(n_remaining / self.n_workers))
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        size = max(size, 1)
+        self.last_size = size
+        return size
+
+    def chunks(self, items: iter, n_items: int = None) -> iter:
+        """Return an iterable of lists of ``items``, sized with the measurements at
+        the time each is created.
+
+        :param n_items: the number of items if known
+
+        """
+        itr = iter(items)
+        while True:
+            remaining = None if n_items is None else max(n_items, 0)
+            chunk = list(it.islice(itr, self.next_size(remaining)))
+            if len(chunk) == 0:
+                break
+            if n_items is not None:
+                n_items -= len(chunk)
+            yield chunk
+
 
 class StashMapReducer(object):
-    def __init__(self, stash: Stash, n_workers: int = 10):
+    """Maps the items of a stash in groups of keys across a pool of worker
+    processes and then reduces the results.
+
+    Each worker keeps its own copy of the reducer, sent once when the pool
+    starts, so only the key groups and the results cross the process
+    boundary.  If ``stash_creator`` is given, the stash is not sent at all
+    and each worker instead creates its own, such as with a ``StashCreator``.
+
+    A pool is created and closed for each call unless the reducer is used as a
+    context manager, in which case its pool is reused until the scope exits,
+    or an existing pool is given to share it across reducers.  A shared pool
+    was not started by the reducer, so the (stash-less if ``stash_creator``
+    is given) pickled reducer is sent with each task, but it is still only
+    unpickled once per worker.
+
+    In streaming mode, each key group is mapped and reduced in the worker and
+    the reduced values are merged with ``_reduce_final`` as they finish in a
+    tree of reductions run in the pool, so the parent holds only a few
+    reduced values at a time.  This requires ``_reduce_final`` to accept a
+    list of its own results (i.e. be associative, such as ``sum``).
+
+    If a result stash is given, workers dump each mapped value to it by key
+    (or each ``_map_batch`` result by the first key of its group) instead of
+    returning it.  Then ``map`` returns the result stash and calling the
+    reducer gives it to ``_reduce_final``, which by default returns it as is.
+    The result stash must be visible across processes, such as a
+    ``DirectoryStash``.
+
+    By default the keys are split in to one group per worker.  If
+    ``chunk_duration`` is given, key groups are instead sized as they are
+    dispatched by an ``AdaptiveChunker`` to take about that many seconds each,
+    which keeps all workers busy when the cost of items varies.
+
+    The workers are processes by default, but may instead be threads or the
+    calling thread (see ``create_pool``), or those of a ``concurrent.futures``
+    executor.
+
+    """
+    def __init__(self, stash: Stash = None, n_workers: int = 10,
+                 stash_creator: Callable[[], Stash] = None,
+                 streaming: bool = False, fan_in: int = 4,
+                 pool: Pool = None, maxtasksperchild: int = None,
+                 result_stash: Stash = None,
+                 result_creator: Callable[[], Stash] = None,
+                 chunk_duration: float = None, max_group_size: int = None,
+                 backend: str = 'process',
+                 executor: futures.Executor = None):
+        """Initialize.
+
+        :param stash: the stash with the data to map, which defaults to one
+                      created with ``stash_creator``
+        :param n_workers: the number of worker processes
+        :param stash_creator: a picklable callable that returns the stash and
+                              is used to create it in each worker
+        :param streaming: whether to reduce in streaming mode when called
+        :param fan_in: the number of reduced values merged by each node of
+                       the reduction tree in streaming mode
+        :param pool: a pool shared with other reducers, which is not closed by
+                     this instance
+        :param maxtasksperchild: the number of tasks after which a worker in
+                                 pools created by this reducer is replaced
+        :param result_stash: the stash to which mapped values are dumped,
+                             which defaults to one created with
+                             ``result_creator``
+        :param result_creator: a picklable callable that returns the result
+                               stash and is used to create it in each worker
+        :param chunk_duration: the seconds each key group should take to map,
+                               which sizes the groups adaptively
+        :param max_group_size: the largest adaptively sized key group
+        :param backend: the kind of workers in pools created by this reducer:
+                        ``process``, ``thread`` or ``serial``
+        :param executor: a ``concurrent.futures`` executor used as the pool
+                         instead of ``backend``, which isn't shut down by
+                         this instance
+
+        """
+        if stash is None:
+            if stash_creator is None:
+                raise ValueError('either a stash or a stash creator is needed')
+            stash = stash_creator()
         self.stash = stash
         self.n_workers = n_workers
+        self.stash_creator = stash_creator
+        self.streaming = streaming
+        self.fan_in = max(fan_in, 2)
+        self.maxtasksperchild = maxtasksperchild
+        self._token = uuid.uuid4().hex
+        self._shared_pool = pool
+        self._pool = None
+        if result_stash is None and result_creator is not None:
+            result_stash = result_creator()
+        self.result_stash = result_stash
+        self.result_creator = result_creator
+        self.chunk_duration = chunk_duration
+        self.max_group_size = max_group_size
+        self.backend = backend
+        self.executor = executor
+
+    def _init_worker(self):
+        """Called in each worker when it starts.
+
+        """
+        if self.stash is None:
+            self.stash = self.stash_creator()
+        if self.result_stash is None and self.result_creator is not None:
+            self.result_stash = self.result_creator()
+
+    @property
+    def spill(self) -> bool:
+        "Whether mapped values are dumped to the result stash."
+        return self.result_stash is not None or \
+            self.result_creator is not None
 
     @property
     def key_group_size(self):
@@ -28,6 +357,14 @@ class StashMapReducer(object):
     def _map(self, id: str, val):
         return (id, val)
 
+    def _combine(self, vals: tuple):
+        """Combine the mapped values of a key group in the worker before they are
+        sent to the parent, such as summing them so only the partial aggregate
+        crosses the process boundary.  The result is given to ``_reduce``.
+
+        """
+        return vals
+
     def _reduce(self, vals):
         return vals
 
@@ -35,22 +372,211 @@ class StashMapReducer(object):
         return reduced_vals
 
     def _map_ids(self, id_sets):
+        """Map a group of keys.  If the subclass defines a
+        ``_map_batch(ids, vals)`` method, it is called once with the group's
+        keys and its values loaded with the stash's ``load_batch``, and its
+        result (i.e. a stacked array) is used instead of the tuple of
+        ``_map`` results.
+
+        """
+        map_batch = getattr(self, '_map_batch', None)
+        if map_batch is not None:
+            ids = tuple(id_sets)
+            res = map_batch(ids, self.stash.load_batch(ids))
+            if self.spill:
+                if len(ids) == 0:
+                    return 0
+                self.result_stash.dump(ids[0], res)
+                return 1
+            return res
+        if self.spill:
+            cnt = 0
+            for id in id_sets:
+                self.result_stash.dump(id, self._map(id, self.stash[id]))
+                cnt += 1
+            return cnt
         return tuple(map(lambda id: self._map(id, self.stash[id]), id_sets))
 
-    def map(self):
+    @property
+    def _in_process(self) -> bool:
+        "Whether the workers of the pools created by this reducer are threads."
+        return self.executor is None and self.backend != 'process'
+
+    def _create_pool(self) -> Pool:
+        if self._in_process:
+            # workers are given this instance with each task
+            self._init_worker()
+            return create_pool(self.backend, self.n_workers)
+        return create_pool(self.backend, self.n_workers, _init_map_worker,
+                           (self._token, self), self.maxtasksperchild,
+                           self.executor)
+
+    @contextmanager
+    def _pool_scope(self):
+        """Provide the pool used for one invocation, which is closed at the end of
+        the scope only when it was created for it.
+
+        """
+        pool = self._shared_pool or self._pool
+        if pool is not None:
+            yield pool
+        else:
+            pool = self._create_pool()
+            try:
+                yield pool
+                pool.close()
+            except BaseException as e:
+                pool.terminate()
+                raise e
+            finally:
+                pool.join()
+                _WORKER_REDUCERS.pop(self._token, None)
+
+    def _worker_state(self):
+        """Return the pickled reducer sent with each task, which is only needed for
+        pools not started by this reducer, or the reducer itself when its
+        workers are threads.
+
+        """
+        if self._shared_pool is not None:
+            return pickle.dumps(self)
+        if self._in_process:
+            return self
+
+    def _tasks(self, state: bytes) -> iter:
+        "Return the key group tasks sent to the workers."
         id_sets = self.stash.key_groups(self.key_group_size)
-        pool = Pool(self.n_workers)
-        return pool.map(self._map_ids, id_sets)
+        return map(lambda ids: (self._token, ids, state), id_sets)
+
+    def _create_chunker(self) -> AdaptiveChunker:
+        return AdaptiveChunker(self.chunk_duration, self.n_workers,
+                               max_size=self.max_group_size)
+
+    def _adaptive_map(self, pool: Pool, fn: Callable, state: bytes,
+                      ordered: bool = True) -> iter:
+        """Map key groups sized with an ``AdaptiveChunker`` using the time workers
+        take on those already finished.
+
+        :param fn: the worker function called with each key group task
+        :param ordered: whether to return the results in key order, otherwise
+                        they are returned as they finish
+
+        """
+        chunker = self._create_chunker()
+        id_sets = chunker.chunks(self.stash.keys(), len(self.stash))
+        tasks = map(lambda x: (fn, x[0], (self._token, x[1], state)),
+                    enumerate(id_sets))
+
+        def observe():
+            for idx, n_ids, elapsed, res in imap_bounded(
+                    pool, _timed_worker, tasks, self.n_workers * 2):
+                chunker.observe(n_ids, elapsed)
+                yield (idx, res)
+
+        results = observe()
+        if ordered:
+            results = sorted(results, key=lambda x: x[0])
+        return map(lambda x: x[1], results)
+
+    def map(self):
+        with self._pool_scope() as pool:
+            state = self._worker_state()
+            if self.spill:
+                fn = _map_spill_worker
+                with time('dumped {cnt} results'):
+                    if self.chunk_duration is None:
+                        cnt = sum(pool.map(fn, self._tasks(state)))
+                    else:
+                        cnt = sum(self._adaptive_map(pool, fn, state, False))
+                return self.result_stash
+            if self.chunk_duration is None:
+                return pool.map(_map_worker, self._tasks(state))
+            return list(self._adaptive_map(pool, _map_worker, state))
+
+    def _stream_reduce(self, pool: Pool):
+        """Reduce each key group in the workers as they finish and merge them as a
+        tree in the pool.
+
+        """
+        state = self._worker_state()
+        reduced = []
+        merges = []
+
+        def harvest(block: bool):
+            for res in tuple(merges):
+                if res.ready():
+                    merges.remove(res)
+                    reduced.append(res.get())
+            if block and len(merges) > 0 and len(reduced) < self.fan_in:
+                res = merges.pop(0)
+                reduced.append(res.get())
+
+        def merge():
+            while len(reduced) >= self.fan_in:
+                vals = reduced[:self.fan_in]
+                del reduced[:self.fan_in]
+                merges.append(pool.apply_async(
+                    _merge_worker, ((self._token, vals, state),)))
+
+        if self.chunk_duration is None:
+            vals = pool.imap_unordered(_map_reduce_worker, self._tasks(state))
+        else:
+            vals = self._adaptive_map(pool, _map_reduce_worker, state, False)
+        for val in vals:
+            reduced.append(val)
+            harvest(False)
+            merge()
+        while len(merges) > 0:
+            harvest(True)
+            merge()
+        return self._reduce_final(reduced)
 
     def __call__(self):
+        if self.spill:
+            return self._reduce_final(self.map())
+        if self.streaming:
+            with self._pool_scope() as pool:
+                return self._stream_reduce(pool)
         mapval = self.map()
         reduced = map(self._reduce, mapval)
         return self._reduce_final(reduced)
 
+    def close(self):
+        """Close and wait on the pool created by entering the reducer's context.
+
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        _WORKER_REDUCERS.pop(self._token, None)
+
+    def __enter__(self):
+        if self._shared_pool is None and self._pool is None:
+            self._pool = self._create_pool()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is not None and self._pool is not None:
+            self._pool.terminate()
+        self.close()
+
+    def __getstate__(self):
+        state = copy(self.__dict__)
+        if self.stash_creator is not None:
+            state['stash'] = None
+        if self.result_creator is not None:
+            state['result_stash'] = None
+        state['_shared_pool'] = None
+        state['_pool'] = None
+        state['executor'] = None
+        return state
+
 
 class FunctionStashMapReducer(StashMapReducer):
-    def __init__(self, stash: Stash, func, n_workers: int = 10):
-        super(FunctionStashMapReducer, self).__init__(stash, n_workers)
+    def __init__(self, stash: Stash, func, n_workers: int = 10, **kwargs):
+        super(FunctionStashMapReducer, self).__init__(
+            stash, n_workers, **kwargs)
         self.func = func
 
     def _map(self, id: str, val):
@@ -61,7 +587,251 @@ class FunctionStashMapReducer(StashMapReducer):
         mr = FunctionStashMapReducer(*args, **kwargs)
         return mr.map()
 
-
+
+def imap_bounded(pool: Pool, fn: Callable, iterable: iter,
+                 max_pending: int) -> iter:
+    """Like ``Pool.imap_unordered``, but never takes more than ``max_pending``
+    elements from ``iterable`` ahead of the results consumed.
+    ``imap_unordered`` reads the entire iterable in its task thread, so
+    without this back pressure every element would be in memory at once.
+
+    :param pool: the pool used to invoke ``fn``
+    :param fn: the function called in the pool with each element
+    :param iterable: the (usually lazy) elements
+    :param max_pending: the maximum number of elements dispatched for which
+                        the result has not yet been consumed
+
+    """
+    results = queue.Queue()
+    itr = iter(iterable)
+    n_pending = 0
+    exhausted = False
+    while True:
+        while not exhausted and n_pending < max_pending:
+            try:
+                arg = next(itr)
+            except StopIteration:
+                exhausted = True
+                break
+            pool.apply_async(fn, (arg,),
+                             callback=lambda r: results.put((True, r)),
+                             error_callback=lambda e: results.put((False, e)))
+            n_pending += 1
+        if n_pending == 0:
+            break
+        success, res = results.get()
+        n_pending -= 1
+        if not success:
+            raise res
+        yield res
+
+
+class SerialResult(object):
+    """The already computed result of a task given to ``SerialPool``, which has
+    the same methods as ``multiprocessing.pool.AsyncResult``.
+
+    """
+    def __init__(self, value=None, error: Exception = None):
+        self.value = value
+        self.error = error
+
+    def ready(self) -> bool:
+        return True
+
+    def successful(self) -> bool:
+        return self.error is None
+
+    def wait(self, timeout: float = None):
+        pass
+
+    def get(self, timeout: float = None):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class SerialPool(object):
+    """A pool that runs each task in the calling thread when it is given, which
+    has the same API as ``multiprocessing.Pool``.  This is useful to profile
+    and debug work otherwise done in worker processes.
+
+    """
+    def __init__(self, processes: int = None, initializer: Callable = None,
+                 initargs: tuple = (), maxtasksperchild: int = None):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def apply_async(self, func: Callable, args: tuple = (), kwds: dict = {},
+                    callback: Callable = None,
+                    error_callback: Callable = None) -> SerialResult:
+        try:
+            res = SerialResult(func(*args, **kwds))
+        except Exception as e:
+            if error_callback is not None:
+                error_callback(e)
+            return SerialResult(error=e)
+        if callback is not None:
+            callback(res.value)
+        return res
+
+    def apply(self, func: Callable, args: tuple = (), kwds: dict = {}):
+        return func(*args, **kwds)
+
+    def map(self, func: Callable, iterable: iter, chunksize: int = None):
+        return list(map(func, iterable))
+
+    def imap(self, func: Callable, iterable: iter, chunksize: int = 1):
+        return map(func, iterable)
+
+    imap_unordered = imap
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.terminate()
+
+
+def _executor_task(token: str, initializer: Callable, initargs: tuple,
+                   func: Callable, args: tuple, kwds: dict):
+    """Run a task given to an ``ExecutorPool``, first calling the pool's
+    initializer if it hasn't run in this process.
+
+    """
+    if token not in _EXECUTOR_INITIALIZED:
+        if initializer is not None:
+            initializer(*initargs)
+        _EXECUTOR_INITIALIZED.add(token)
+    return func(*args, **kwds)
+
+
+class ExecutorPool(object):
+    """Adapts a ``concurrent.futures.Executor`` to the ``multiprocessing.Pool``
+    API.  Since executors have no hook for when a worker starts, the
+    initializer and its arguments are sent with each task and called once per
+    process.  The executor belongs to the caller, so it is not shut down when
+    the pool is closed.
+
+    """
+    def __init__(self, executor: futures.Executor,
+                 initializer: Callable = None, initargs: tuple = ()):
+        self.executor = executor
+        self.initializer = initializer
+        self.initargs = initargs
+        self.token = uuid.uuid4().hex
+
+    def _submit(self, func: Callable, args: tuple = (), kwds: dict = {}):
+        return self.executor.submit(
+            _executor_task, self.token, self.initializer, self.initargs,
+            func, args, kwds)
+
+    def apply_async(self, func: Callable, args: tuple = (), kwds: dict = {},
+                    callback: Callable = None,
+                    error_callback: Callable = None):
+        fut = self._submit(func, args, kwds)
+
+        def done(fut):
+            error = fut.exception()
+            if error is None:
+                if callback is not None:
+                    callback(fut.result())
+            elif error_callback is not None:
+                error_callback(error)
+
+        fut.add_done_callback(done)
+        return _FutureResult(fut)
+
+    def apply(self, func: Callable, args: tuple = (), kwds: dict = {}):
+        return self._submit(func, args, kwds).result()
+
+    def imap(self, func: Callable, iterable: iter, chunksize: int = 1):
+        futs = [self._submit(func, (arg,)) for arg in iterable]
+        return map(lambda f: f.result(), futs)
+
+    def map(self, func: Callable, iterable: iter, chunksize: int = None):
+        return list(self.imap(func, iterable))
+
+    def imap_unordered(self, func: Callable, iterable: iter,
+                       chunksize: int = 1):
+        futs = [self._submit(func, (arg,)) for arg in iterable]
+        return map(lambda f: f.result(), futures.as_completed(futs))
+
+    def close(self):
+        _EXECUTOR_INITIALIZED.discard(self.token)
+
+    def join(self):
+        pass
+
+    def terminate(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.terminate()
+
+
+class _FutureResult(object):
+    """Gives a ``Future`` the methods of ``multiprocessing.pool.AsyncResult``.
+
+    """
+    def __init__(self, future):
+        self.future = future
+
+    def ready(self) -> bool:
+        return self.future.done()
+
+    def successful(self) -> bool:
+        return self.future.exception() is None
+
+    def wait(self, timeout: float = None):
+        futures.wait((self.future,), timeout)
+
+    def get(self, timeout: float = None):
+        return self.future.result(timeout)
+
+
+POOL_BACKENDS = {'process': Pool,
+                 'thread': ThreadPool,
+                 'serial': SerialPool}
+"""The pool classes by backend name."""
+
+
+def create_pool(backend: str, processes: int, initializer: Callable = None,
+                initargs: tuple = (), maxtasksperchild: int = None,
+                executor: futures.Executor = None):
+    """Create a pool with the ``multiprocessing.Pool`` API.
+
+    :param backend: the name of the pool class in ``POOL_BACKENDS``; the
+                    ``thread`` and ``serial`` backends run in this process, so
+                    nothing is pickled
+    :param processes: the number of workers
+    :param initializer: called with ``initargs`` when each worker starts
+    :param maxtasksperchild: the number of tasks after which a process worker
+                             is replaced
+    :param executor: if given, a ``concurrent.futures`` executor used instead
+                     of ``backend``
+
+    """
+    if executor is not None:
+        return ExecutorPool(executor, initializer, initargs)
+    if backend not in POOL_BACKENDS:
+        raise ValueError(f'unknown pool backend: {backend}')
+    if backend == 'process':
+        return Pool(processes, initializer, initargs, maxtasksperchild)
+    return POOL_BACKENDS[backend](processes, initializer, initargs)
+
+
 @dataclass
 class ChunkProcessor(object):
     """Represents a chunk of work created by the parent and processed on the child.
@@ -80,7 +850,14 @@ class ChunkProcessor(object):
     data: object
 
     def _create_stash(self):
-        return StashFactory(self.config).instance(self.name)
+        """Return the stash created when the worker started, or a new one if it
+        isn't resident.
+
+        """
+        stash = _WORKER_STASHES.get(self.name)
+        if stash is None:
+            stash = StashFactory(self.config).instance(self.name)
+        return stash
 
     def process(self):
         """Create the stash used to process the data, then persisted in the stash.
@@ -97,19 +874,653 @@ class ChunkProcessor(object):
         return f'{self.name}: data: {type(self.data)}'
 
 
+class ChunkManifest(object):
+    """An append only log of the chunks processed by a ``MultiProcessStash``,
+    which is used to resume priming after a crash.  Each line is a JSON
+    object recording the outcome and item span of a chunk, or that all chunks
+    completed.  A partially written last line is ignored.
+
+    """
+    def __init__(self, path: Path):
+        self.path = path
+
+    def __str__(self):
+        return str(self.path)
+
+    def _entries(self) -> iter:
+        if self.path.is_file():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        logger.warning(f'skipping manifest entry: {line}')
+
+    @property
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    @property
+    def complete(self) -> bool:
+        "Whether all chunks completed successfully."
+        return any(map(lambda e: e.get('complete', False), self._entries()))
+
+    @property
+    def done_chunks(self) -> Set[int]:
+        """Return the IDs of chunks that completed successfully.
+
+        """
+        done = set()
+        for e in self._entries():
+            if 'chunk' in e:
+                if e['status'] == 'done':
+                    done.add(e['chunk'])
+                else:
+                    done.discard(e['chunk'])
+        return done
+
+    @property
+    def done_spans(self) -> List[Tuple[int, int]]:
+        """Return the sorted and merged ``(start, end)`` item offsets of the chunks
+        that completed successfully.
+
+        """
+        spans = []
+        for e in sorted(filter(lambda e: e.get('status') == 'done',
+                               self._entries()),
+                        key=lambda e: e['offset']):
+            start, end = e['offset'], e['offset'] + e['size']
+            if len(spans) > 0 and start <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(end, spans[-1][1]))
+            else:
+                spans.append((start, end))
+        return spans
+
+    @property
+    def quarantined(self) -> List[dict]:
+        """Return the entries of the quarantined chunks, which are not processed
+        again until the manifest is cleared.
+
+        """
+        return list(filter(lambda e: e.get('status') == 'quarantined',
+                           self._entries()))
+
+    @property
+    def next_chunk_id(self) -> int:
+        "The chunk ID after the last recorded."
+        ids = tuple(map(lambda e: e['chunk'],
+                        filter(lambda e: 'chunk' in e, self._entries())))
+        return (max(ids) + 1) if len(ids) > 0 else 0
+
+    def _append(self, entry: dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+
+    def record(self, chunk_id: int, offset: int, size: int,
+               count: int = None, error: str = None,
+               quarantined: bool = False):
+        """Record the outcome of a chunk.
+
+        :param chunk_id: the chunk processed
+        :param offset: the index of the chunk's first item in the data
+        :param size: the number of items in the chunk
+        :param count: the number of items dumped if it succeeded
+        :param error: the error message if it failed
+        :param quarantined: whether the failed chunk is not retried
+
+        """
+        entry = {'chunk': chunk_id, 'offset': offset, 'size': size}
+        if error is None:
+            entry.update({'status': 'done', 'count': count})
+        else:
+            status = 'quarantined' if quarantined else 'failed'
+            entry.update({'status': status, 'error': error})
+        self._append(entry)
+
+    def start(self):
+        """Record that priming started, so the manifest exists (and the data is
+        incomplete) before any chunk finishes.
+
+        """
+        self._append({'start': True})
+
+    def mark_complete(self):
+        "Record that all chunks completed."
+        self._append({'complete': True})
+
+    def clear(self):
+        if self.path.is_file():
+            self.path.unlink()
+
+
+def _init_chunk_worker(config: Configurable, name: str):
+    """Pool initializer that creates the multi-process stash once per worker.
+
+    """
+    _WORKER_STASHES[name] = StashFactory(config).instance(name)
+
+
+def _install_chunk_worker(name: str, stash: Stash):
+    """Pool initializer for workers in this process, which use the parent
+    multi-process stash itself.
+
+    """
+    _WORKER_STASHES[name] = stash
+
+
+def _worker_rss() -> int:
+    """Return the resident memory of this process in bytes, or the peak if the
+    current isn't available, or ``None`` if neither is.
+
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        if _resource is not None:
+            # kilobytes on Linux
+            return _resource.getrusage(_resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@dataclass
+class ChunkResult(object):
+    """The outcome of processing a chunk in a worker.
+
+    :param chunk_id: the nth chunk
+    :param count: the number of items dumped, or ``None`` if it failed
+    :param error: the error message if it failed
+    :param pid: the process ID of the worker
+    :param start: the epoch time the worker started the chunk
+    :param end: the epoch time the worker finished the chunk
+    :param rss: the worker's resident memory in bytes after the chunk
+
+    """
+    chunk_id: int
+    count: int
+    error: str
+    pid: int
+    start: float
+    end: float
+    rss: int = None
+
+    @property
+    def elapsed(self) -> float:
+        return self.end - self.start
+
+
+def _process_chunk(task: tuple) -> ChunkResult:
+    """Process the data of a chunk in the worker with the resident stash.
+
+    """
+    name, chunk_id, data = task
+    start = tm.time()
+    stash = _WORKER_STASHES[name]
+    chunk = stash._create_chunk_processor(chunk_id, data)
+    cnt = stash.__class__._process_work(chunk)
+    return ChunkResult(chunk_id, cnt, None, os.getpid(), start, tm.time(),
+                       _worker_rss())
+
+
+def _process_chunk_robust(task: tuple) -> ChunkResult:
+    """Like ``_process_chunk`` but return the error message of a failed chunk
+    rather than raising it.
+
+    """
+    chunk_id = task[1]
+    start = tm.time()
+    try:
+        return _process_chunk(task)
+    except Exception as e:
+        logger.error(f'chunk {chunk_id} failed: {e}', exc_info=True)
+        return ChunkResult(chunk_id, None, f'{type(e).__name__}: {e}',
+                           os.getpid(), start, tm.time())
+
+
+class ChunkSupervisor(object):
+    """Dispatches chunk tasks to a pool like ``imap_bounded``, and in addition:
+
+      * fails chunks that take longer than ``timeout``, which replaces every
+        worker since the one running it is stuck, then sends the chunks that
+        were pending to the new pool (so the pool must be able to terminate
+        its workers, i.e. ``multiprocessing.Pool``),
+      * retries failed chunks up to ``max_retries`` times, waiting
+        ``retry_backoff`` seconds doubled with each attempt,
+      * replaces the workers once the pending chunks finish when a worker's
+        memory grows past ``max_worker_rss``.
+
+    Tasks are those of ``MultiProcessStash`` and are processed with
+    ``_process_chunk_robust``.  Calling the supervisor returns the
+    ``ChunkResult`` of each chunk as it finishes, which for chunks that failed
+    every attempt has its last error.
+
+    """
+    def __init__(self, create_pool: Callable[[], Pool], max_pending: int,
+                 timeout: float = None, max_retries: int = 0,
+                 retry_backoff: float = 1., max_worker_rss: int = None):
+        """Initialize.
+
+        :param create_pool: creates the pool, which is called again to
+                            replace the workers
+        :param max_pending: the maximum number of chunks sent to the pool that
+                            have not finished
+        :param timeout: the seconds after which a pending chunk fails
+        :param max_retries: the number of times a failed chunk is sent again
+        :param retry_backoff: the seconds to wait before the first retry
+        :param max_worker_rss: the resident memory in megabytes of a worker
+                               after which the workers are replaced
+
+        """
+        self.create_pool = create_pool
+        self.max_pending = max(max_pending, 1)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_worker_rss = max_worker_rss
+        self.n_restarts = 0
+
+    def _start(self):
+        self.pool = self.create_pool()
+        self.generation += 1
+
+    def _restart(self, terminate: bool):
+        """Replace the workers, first waiting on those of the current pool unless
+        ``terminate`` is ``True``.
+
+        """
+        logger.info(f'replacing workers (terminate={terminate})')
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        self.n_restarts += 1
+        self._start()
+
+    def _dispatch(self, task: tuple, attempt: int):
+        chunk_id = task[1]
+        gen = self.generation
+        deadline = None
+        if self.timeout is not None:
+            deadline = tm.time() + self.timeout
+        self.pending[chunk_id] = (task, attempt, deadline)
+        self.pool.apply_async(
+            _process_chunk_robust, (task,),
+            callback=lambda r: self.results.put((gen, chunk_id, r)),
+            error_callback=lambda e: self.results.put((gen, chunk_id, e)))
+
+    def _fail(self, task: tuple, attempt: int, res: ChunkResult):
+        """Schedule a failed chunk to be sent again, or return its result if it
+        has no attempts left.
+
+        """
+        if attempt < self.max_retries:
+            delay = self.retry_backoff * (2 ** attempt)
+            logger.warning(f'retrying chunk {res.chunk_id} in {delay}s ' +
+                           f'({attempt + 1}/{self.max_retries}): {res.error}')
+            retry = (tm.time() + delay, res.chunk_id, task, attempt + 1)
+            heapq.heappush(self.retries, retry)
+        else:
+            return res
+
+    def _expire(self) -> List[ChunkResult]:
+        """Fail the pending chunks past their deadline, and if any, replace the
+        workers and schedule the other pending chunks to be sent again.
+
+        """
+        now = tm.time()
+        expired = tuple(filter(lambda x: x[1][2] is not None and
+                               x[1][2] <= now, self.pending.items()))
+        failed = []
+        if len(expired) > 0:
+            for chunk_id, (task, attempt, _) in expired:
+                del self.pending[chunk_id]
+                error = f'TimeoutError: chunk timed out after {self.timeout}s'
+                res = self._fail(task, attempt, ChunkResult(
+                    chunk_id, None, error, None, now - self.timeout, now))
+                if res is not None:
+                    failed.append(res)
+            for chunk_id, (task, attempt, _) in self.pending.items():
+                heapq.heappush(self.retries, (now, chunk_id, task, attempt))
+            self.pending.clear()
+            self._restart(True)
+        return failed
+
+    def _wait_time(self) -> float:
+        """Return the seconds until the next deadline or retry, or ``None`` if
+        there are neither.
+
+        """
+        times = [d for _, _, d in self.pending.values() if d is not None]
+        if len(self.retries) > 0:
+            times.append(self.retries[0][0])
+        if len(times) > 0:
+            return max(min(times) - tm.time(), 0)
+
+    def __call__(self, tasks: iter) -> iter:
+        self.results = queue.Queue()
+        self.pending = {}
+        self.retries = []
+        self.generation = 0
+        itr = iter(tasks)
+        exhausted = False
+        recycle = False
+        self._start()
+        try:
+            while True:
+                while not recycle and len(self.pending) < self.max_pending:
+                    if len(self.retries) > 0 and \
+                       self.retries[0][0] <= tm.time():
+                        _, _, task, attempt = heapq.heappop(self.retries)
+                    elif not exhausted:
+                        try:
+                            task, attempt = next(itr), 0
+                        except StopIteration:
+                            exhausted = True
+                            continue
+                    else:
+                        break
+                    self._dispatch(task, attempt)
+                if len(self.pending) == 0:
+                    if recycle:
+                        self._restart(False)
+                        recycle = False
+                        continue
+                    if len(self.retries) > 0:
+                        tm.sleep(self._wait_time())
+                        continue
+                    if exhausted:
+                        break
+                try:
+                    gen, chunk_id, res = self.results.get(
+                        timeout=self._wait_time())
+                except queue.Empty:
+                    yield from self._expire()
+                    continue
+                if gen != self.generation or chunk_id not in self.pending:
+                    continue
+                task, attempt, _ = self.pending.pop(chunk_id)
+                if isinstance(res, Exception):
+                    now = tm.time()
+                    res = ChunkResult(chunk_id, None,
+                                      f'{type(res).__name__}: {res}',
+                                      None, now, now)
+                if res.error is not None:
+                    res = self._fail(task, attempt, res)
+                    if res is None:
+                        continue
+                elif self.max_worker_rss is not None and \
+                        res.rss is not None and \
+                        res.rss > self.max_worker_rss * 1024 * 1024:
+                    logger.info(f'worker {res.pid} has {res.rss} bytes ' +
+                                'resident, so replacing workers')
+                    recycle = True
+                yield res
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+
+
+class ChunkProgress(object):
+    """Progress and throughput of the chunks processed by a
+    ``MultiProcessStash``, which includes the time each worker spent busy and
+    idle, and the slowest chunks.
+
+    """
+    N_SLOWEST = 5
+    """The number of slowest chunks to track."""
+
+    def __init__(self, n_chunks: int = None):
+        """Initialize.
+
+        :param n_chunks: the number of chunks to process if known, which is
+                         needed for the ETA
+
+        """
+        self.n_chunks = n_chunks
+        self.start = tm.time()
+        self.end = None
+        self.chunks = 0
+        self.items = 0
+        self.failed = 0
+        self.busy = {}
+        self.slowest = []
+
+    def update(self, result: ChunkResult):
+        """Add a finished chunk.
+
+        """
+        self.chunks += 1
+        if result.error is None:
+            self.items += result.count
+        else:
+            self.failed += 1
+        elapsed = result.elapsed
+        if result.pid is not None:
+            self.busy[result.pid] = self.busy.get(result.pid, 0) + elapsed
+        entry = (elapsed, result.chunk_id)
+        if len(self.slowest) < self.N_SLOWEST:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def finish(self):
+        self.end = tm.time()
+
+    @property
+    def elapsed(self) -> float:
+        "The seconds since processing started."
+        return (self.end or tm.time()) - self.start
+
+    @property
+    def items_per_second(self) -> float:
+        elapsed = self.elapsed
+        return (self.items / elapsed) if elapsed > 0 else 0.
+
+    @property
+    def eta(self) -> float:
+        """The estimated seconds until all chunks finish, or ``None`` if the
+        number of chunks isn't known.
+
+        """
+        if self.n_chunks is not None and self.chunks > 0:
+            remaining = max(self.n_chunks - self.chunks, 0)
+            return remaining * self.elapsed / self.chunks
+
+    @property
+    def workers(self) -> Dict[int, Dict[str, float]]:
+        """The seconds each worker (by process ID) spent processing chunks and
+        waiting for them since processing started.
+
+        """
+        elapsed = self.elapsed
+        return {pid: {'busy': busy, 'idle': max(elapsed - busy, 0)}
+                for pid, busy in self.busy.items()}
+
+    @property
+    def slowest_chunks(self) -> Dict[int, float]:
+        "The slowest chunk IDs with their processing seconds, slowest first."
+        return OrderedDict(map(lambda x: (x[1], x[0]),
+                               sorted(self.slowest, reverse=True)))
+
+    def asdict(self) -> dict:
+        return {'chunks': self.chunks,
+                'n_chunks': self.n_chunks,
+                'items': self.items,
+                'failed': self.failed,
+                'elapsed': self.elapsed,
+                'items_per_second': self.items_per_second,
+                'eta': self.eta,
+                'complete': self.end is not None,
+                'workers': {str(k): v for k, v in self.workers.items()},
+                'slowest_chunks': {str(k): v for k, v
+                                   in self.slowest_chunks.items()}}
+
+    def write(self, writer=sys.stdout, indent=0):
+        sp = ' ' * indent
+        writer.write(f'{sp}{self}\n')
+        writer.write(f'{sp}workers:\n')
+        for pid, times in sorted(self.workers.items()):
+            writer.write(f'{sp}  {pid}: busy={times["busy"]:.2f}s, ' +
+                         f'idle={times["idle"]:.2f}s\n')
+        writer.write(f'{sp}slowest chunks:\n')
+        for chunk_id, elapsed in self.slowest_chunks.items():
+            writer.write(f'{sp}  {chunk_id}: {elapsed:.2f}s\n')
+
+    def __str__(self):
+        total = '?' if self.n_chunks is None else self.n_chunks
+        s = (f'chunks: {self.chunks}/{total}, items: {self.items}, ' +
+             f'{self.items_per_second:.1f} items/s')
+        if self.failed > 0:
+            s += f', failed: {self.failed}'
+        eta = self.eta
+        if eta is not None and self.end is None:
+            s += f', eta: {eta:.0f}s'
+        return s
+
+
+class ProgressReporter(object):
+    """Reports the ``ChunkProgress`` of a ``MultiProcessStash`` as chunks finish.
+    This base class reports nothing, and subclasses override ``_report``.
+
+    """
+    def __init__(self, interval: float = 10):
+        """Initialize.
+
+        :param interval: the minimum seconds between reports while processing
+
+        """
+        self.interval = interval
+        self.progress = None
+
+    def start(self, n_chunks: int = None):
+        self.progress = ChunkProgress(n_chunks)
+        self._last_report = tm.time()
+
+    def update(self, result: ChunkResult):
+        self.progress.update(result)
+        now = tm.time()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self._report(False)
+
+    def finish(self):
+        self.progress.finish()
+        self._report(True)
+
+    def _report(self, final: bool):
+        """Report the current progress.
+
+        :param final: whether processing finished
+
+        """
+        pass
+
+
+class LogProgressReporter(ProgressReporter):
+    """Log a progress line at the ``info`` level, and the worker and slowest
+    chunk times when finished.
+
+    """
+    def _report(self, final: bool):
+        if logger.isEnabledFor(logging.INFO):
+            if final:
+                sio = StringIO()
+                self.progress.write(sio)
+                logger.info(f'finished {sio.getvalue().rstrip()}')
+            else:
+                logger.info(str(self.progress))
+
+
+class TqdmProgressReporter(ProgressReporter):
+    """Report progress with a ``tqdm`` progress bar of chunks.
+
+    """
+    def __init__(self, interval: float = 0):
+        if tqdm is None:
+            raise ValueError('tqdm is not installed')
+        super(TqdmProgressReporter, self).__init__(interval)
+
+    def start(self, n_chunks: int = None):
+        super(TqdmProgressReporter, self).start(n_chunks)
+        self.bar = tqdm(total=n_chunks, unit='chunk')
+
+    def update(self, result: ChunkResult):
+        super(TqdmProgressReporter, self).update(result)
+        self.bar.update(1)
+
+    def _report(self, final: bool):
+        self.bar.set_postfix(items=self.progress.items,
+                             rate=f'{self.progress.items_per_second:.1f}/s')
+        if final:
+            self.bar.close()
+
+
+class JsonProgressReporter(ProgressReporter):
+    """Write the progress as JSON to a file, which is replaced atomically so it
+    can be read at any time.
+
+    """
+    def __init__(self, path: Path, interval: float = 10):
+        super(JsonProgressReporter, self).__init__(interval)
+        self.path = path
+
+    def _report(self, final: bool):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.parent / f'{self.path.name}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.progress.asdict(), f, indent=4)
+        os.replace(tmp, self.path)
+
+
 class MultiProcessStash(PreemptiveStash, metaclass=ABCMeta):
     """A stash that forks processes to process data in a distributed fashion.  The
     stash is typically created by a ``StashFactory`` in the child process.
     Work is chunked (grouped) and then sent to child processes.  In each, a new
-    instance of this same stash is created using the ``StashFactory`` and then
-    an abstract method is called to dump the data.
+    instance of this same stash is created once using the ``StashFactory``
+    when the worker starts, and then an abstract method is called to dump the
+    data of each chunk.  Only the chunk number and its data are sent to the
+    workers.
+
+    When the delegate has a ``create_path`` (i.e. ``DirectoryStash``), or a
+    ``manifest_path`` is given, the outcome of each chunk is recorded in a
+    ``ChunkManifest``.  The stash then only has data once every chunk
+    succeeded, and priming again after a crash or failure processes only the
+    items of chunks not yet done.  This requires ``_create_data`` to create
+    the same data in the same order each time.  As without a manifest, the
+    first error raised by ``_process`` stops priming.
+
+    Chunks can be given a timeout, retried, and quarantined (see
+    ``ChunkSupervisor``) so one bad or stuck chunk doesn't fail or stall the
+    priming, and the workers can be replaced after some number of chunks or
+    once their memory grows too large.
+
+    If ``background`` is set, priming runs in a thread and loading a key waits
+    only until it is created, which is sooner when ``_key_data_index`` is
+    implemented to move its item to the front of the queue.  Getting the keys
+    still waits for all the data.
 
     To implement, the ``_create_chunks`` and ``_process`` methods must be
     implemented.
 
     """
+    PROGRESS_REPORTERS = {'none': ProgressReporter,
+                          'log': LogProgressReporter,
+                          'tqdm': TqdmProgressReporter,
+                          'json': JsonProgressReporter}
+    """The progress reporter classes by the name given as ``progress``."""
+
     def __init__(self, config: Configurable, name: str, delegate: Stash,
-                 chunk_size: int, workers: int):
+                 chunk_size: int, workers: int, max_pending: int = None,
+                 manifest_path: Path = None, use_manifest: bool = True,
+                 progress: str = 'log', progress_path: Path = None,
+                 progress_interval: float = 10, chunk_duration: float = None,
+                 backend: str = 'process',
+                 executor: futures.Executor = None, background: bool = False,
+                 chunk_timeout: float = None, max_retries: int = 0,
+                 retry_backoff: float = 1., quarantine: bool = False,
+                 maxtasksperchild: int = None, max_worker_rss: int = None):
         """Initialize the stash from a ``StashFactory``.
 
         This class is abstract and subclasses is are usually be created by a
@@ -126,6 +1537,47 @@ class MultiProcessStash(PreemptiveStash, metaclass=ABCMeta):
                            process to be handled; in some cases the child
                            process will get a chunk of data smaller than this
                            (the last) but never more
+        :param workers: the number of worker processes
+        :param max_pending: the maximum number of chunks created and sent to
+                            the workers that have not finished, which bounds
+                            the memory used in the parent; defaults to twice
+                            ``workers``
+        :param manifest_path: the chunk manifest file, which defaults to the
+                              delegate's ``create_path`` with a
+                              ``.manifest`` extension
+        :param use_manifest: whether to record chunks in a manifest
+        :param progress: how progress is reported while priming: ``log``,
+                         ``tqdm`` (which logs if not installed), ``json``
+                         (written to ``progress_path``) or ``none``
+        :param progress_path: the JSON progress file, which defaults to the
+                              manifest path with a ``.progress.json``
+                              extension
+        :param progress_interval: the minimum seconds between progress reports
+        :param chunk_duration: the seconds each chunk should take to process,
+                               in which case chunks are sized adaptively (see
+                               ``AdaptiveChunker``) up to ``chunk_size``
+        :param backend: the kind of workers: ``process``, ``thread`` (for I/O
+                        bound work) or ``serial`` (for profiling), where the
+                        last two use this instance rather than creating the
+                        stash in each worker
+        :param executor: a ``concurrent.futures`` executor used instead of
+                         ``backend``, which isn't shut down by this instance
+        :param background: whether to prime in a background thread, in which
+                           case loading a key not yet created waits only for
+                           it (see ``_key_data_index``)
+        :param chunk_timeout: the seconds after which a chunk fails, and the
+                              (stuck) workers are replaced, which is only
+                              possible with the ``process`` backend
+        :param max_retries: the number of times a failed chunk is retried
+        :param retry_backoff: the seconds before the first retry of a chunk,
+                              which doubles with each attempt
+        :param quarantine: whether chunks that fail every attempt are logged
+                           and recorded as quarantined in the manifest
+                           instead of failing priming
+        :param maxtasksperchild: the number of chunks after which a process
+                                 worker is replaced
+        :param max_worker_rss: the resident memory in megabytes of a worker
+                               after which the workers are replaced
 
         """
         super(MultiProcessStash, self).__init__(delegate)
@@ -133,6 +1585,79 @@ class MultiProcessStash(PreemptiveStash, metaclass=ABCMeta):
         self.name = name
         self.chunk_size = chunk_size
         self.workers = workers
+        if max_pending is None:
+            max_pending = workers * 2
+        self.max_pending = max(max_pending, 1)
+        if manifest_path is None and use_manifest:
+            cpath = getattr(delegate, 'create_path', None)
+            if isinstance(cpath, Path):
+                manifest_path = cpath.parent / f'{cpath.name}.manifest'
+        if manifest_path is None or not use_manifest:
+            self.manifest = None
+        else:
+            self.manifest = ChunkManifest(manifest_path)
+        if progress not in self.PROGRESS_REPORTERS:
+            raise ValueError(f'unknown progress reporter: {progress}')
+        if progress == 'json' and progress_path is None:
+            if manifest_path is None:
+                raise ValueError('json progress needs a progress path')
+            progress_path = manifest_path.parent / \
+                f'{manifest_path.stem}.progress.json'
+        self.progress = progress
+        self.progress_path = progress_path
+        self.progress_interval = progress_interval
+        self.last_progress = None
+        self.chunk_duration = chunk_duration
+        if backend not in POOL_BACKENDS:
+            raise ValueError(f'unknown pool backend: {backend}')
+        self.backend = backend
+        self.executor = executor
+        self.background = background
+        self.chunk_timeout = chunk_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.quarantine = quarantine
+        self.maxtasksperchild = maxtasksperchild
+        self.max_worker_rss = max_worker_rss
+        self._assert_timeout_supported()
+        self.quarantined = []
+        self._init_priming()
+
+    def _init_priming(self):
+        "Create the state used to prime in the background."
+        self._urgent = queue.Queue()
+        self._prime_lock = threading.Lock()
+        self._prime_cond = threading.Condition()
+        self._prime_thread = None
+        self._prime_error = None
+
+    def __getstate__(self):
+        state = copy(self.__dict__)
+        for k in ('_urgent _prime_lock _prime_cond _prime_thread ' +
+                  '_prime_error').split():
+            del state[k]
+        state['executor'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_priming()
+
+    def _calculate_has_data(self) -> bool:
+        # data created before manifests (no manifest file) is taken as complete
+        if self.manifest is not None and self.manifest.exists:
+            if not hasattr(self, '_has_data'):
+                complete = self.manifest.complete
+                if complete and \
+                   not super(MultiProcessStash, self)._calculate_has_data():
+                    # the data was removed without the manifest
+                    logger.info(f'removing stale manifest {self.manifest}')
+                    self.manifest.clear()
+                    complete = False
+                self._reset_has_data()
+                self._has_data = complete
+            return self._has_data
+        return super(MultiProcessStash, self)._calculate_has_data()
 
     @abstractmethod
     def _create_data(self) -> list:
@@ -149,6 +1674,16 @@ class MultiProcessStash(PreemptiveStash, metaclass=ABCMeta):
         """
         pass
 
+    def _key_data_index(self, name: str) -> int:
+        """Return the index of the item in the data from ``_create_data`` that
+        creates key ``name``, or ``None`` if it isn't known.  When priming in
+        the background, an index for a key not yet created moves its item to
+        the front of the queue if the data can be indexed (i.e. is a list),
+        otherwise the load waits for its chunk.
+
+        """
+        return None
+
     @staticmethod
     def _process_work(chunk: ChunkProcessor) -> int:
         """Process a chunk of data in the child process that was created by the parent
@@ -163,18 +1698,218 @@ class MultiProcessStash(PreemptiveStash, metaclass=ABCMeta):
         """
         return ChunkProcessor(self.config, self.name, chunk_id, data)
 
+    def _create_reporter(self) -> ProgressReporter:
+        """Factory method to create the progress reporter used while priming.
+
+        """
+        progress = self.progress
+        if progress == 'tqdm' and tqdm is None:
+            logger.info('tqdm not installed--logging progress')
+            progress = 'log'
+        if progress == 'json':
+            return JsonProgressReporter(self.progress_path,
+                                        self.progress_interval)
+        return self.PROGRESS_REPORTERS[progress](self.progress_interval)
+
+    def _create_chunker(self) -> AdaptiveChunker:
+        """Return the chunker that sizes chunks, or ``None`` when chunks have a fixed
+        ``chunk_size``.
+
+        """
+        if self.chunk_duration is not None:
+            return AdaptiveChunker(self.chunk_duration, self.workers,
+                                   max_size=self.chunk_size)
+
+    def _chunk_tasks(self, data: iter, done: List[Tuple[int, int]],
+                     chunker: AdaptiveChunker, n_items: int,
+                     spans: Dict[int, Tuple[int, int]]) -> iter:
+        """Return the chunk tasks sent to the workers.  Each chunk is a run of
+        consecutive items, so its span is recorded in the manifest.
+
+        :param data: the data created by ``_create_data``
+        :param done: the ``(start, end)`` item offsets of chunks already done
+        :param chunker: sizes the chunks, or ``None`` for ``chunk_size``
+        :param n_items: the number of items left to process if known
+        :param spans: populated with the ``(offset, size)`` by chunk ID
+
+        """
+        starts = tuple(map(lambda x: x[0], done))
+        # indexes of items sent ahead of their chunk by ``_prioritize``
+        urgent = set()
+        n_pulled = 0
+        chunk_id = 0 if self.manifest is None else self.manifest.next_chunk_id
+
+        def pending(i: int) -> bool:
+            idx = bisect_right(starts, i) - 1
+            return (idx < 0 or i >= done[idx][1]) and i not in urgent
+
+        def enum():
+            nonlocal n_pulled
+            for i, item in enumerate(data):
+                n_pulled = i + 1
+                yield (i, item)
+
+        def task(chunk: tuple) -> tuple:
+            nonlocal chunk_id, n_items
+            if n_items is not None:
+                n_items -= len(chunk)
+            spans[chunk_id] = (chunk[0][0], len(chunk))
+            chunk_id += 1
+            return (self.name, chunk_id - 1, list(map(lambda x: x[1], chunk)))
+
+        def urgent_tasks() -> iter:
+            while True:
+                try:
+                    idx = self._urgent.get_nowait()
+                except queue.Empty:
+                    break
+                if idx >= n_pulled and pending(idx):
+                    try:
+                        item = data[idx]
+                    except (TypeError, IndexError):
+                        continue
+                    urgent.add(idx)
+                    yield task(((idx, item),))
+
+        runs = it.groupby(filter(lambda x: pending(x[0]), enum()),
+                          key=lambda x, c=it.count(): x[0] - next(c))
+        for _, run in runs:
+            while True:
+                yield from urgent_tasks()
+                if chunker is None:
+                    size = self.chunk_size
+                else:
+                    size = chunker.next_size(n_items)
+                chunk = tuple(it.islice(run, size))
+                if len(chunk) == 0:
+                    break
+                yield task(chunk)
+
+    def _assert_timeout_supported(self):
+        """Raise an error if a chunk timeout is set but the workers that time out
+        can't be stopped, which are threads, the calling thread (``serial``)
+        and those of an executor.
+
+        """
+        if self.chunk_timeout is not None and \
+           (self.backend != 'process' or self.executor is not None):
+            raise ValueError('chunk timeouts need the process backend ' +
+                             'without an executor')
+
+    @property
+    def _supervised(self) -> bool:
+        "Whether chunks are dispatched by a ``ChunkSupervisor``."
+        return self.chunk_timeout is not None or self.max_retries > 0 or \
+            self.quarantine or self.max_worker_rss is not None
+
     def _spawn_work(self) -> int:
         """Chunks and invokes a multiprocessing pool to invokes processing on the
-        children.
+        children.  Chunks are created lazily as workers finish others, so
+        processing starts with the first chunk.
 
         """
-        data = map(lambda x: self._create_chunk_processor(*x),
-                   enumerate(chunks(self._create_data(), self.chunk_size)))
-        logger.debug(f'spawning {self.chunk_size} chunks across ' +
+        data = self._create_data()
+        n_items = len(data) if hasattr(data, '__len__') else None
+        done = []
+        if self.manifest is not None:
+            done = self.manifest.done_spans
+            n_done = sum(map(lambda x: x[1] - x[0], done))
+            if n_done > 0:
+                logger.info(f'resuming with {n_done} items done')
+                if n_items is not None:
+                    n_items = max(n_items - n_done, 0)
+            self.manifest.start()
+        chunker = self._create_chunker()
+        n_chunks = None
+        if chunker is None and n_items is not None:
+            n_chunks = math.ceil(n_items / self.chunk_size)
+        spans = {}
+        tasks = self._chunk_tasks(data, done, chunker, n_items, spans)
+        logger.debug(f'spawning chunks of size {self.chunk_size} across ' +
                      f'{self.workers} workers')
-        with Pool(self.workers) as p:
-            with time('processed chunks'):
-                cnt = sum(p.map(self.__class__._process_work, data))
+        if self.executor is None and self.backend != 'process':
+            init = (_install_chunk_worker, (self.name, self))
+        else:
+            init = (_init_chunk_worker, (self.config, self.name))
+        pool_args = (self.backend, self.workers, *init, self.maxtasksperchild,
+                     self.executor)
+        try:
+            self._assert_timeout_supported()
+            if self._supervised:
+                max_pending = self.max_pending
+                if self.chunk_timeout is not None:
+                    # pending chunks start right away so they time out from
+                    # when they start
+                    max_pending = min(max_pending, self.workers)
+                supervisor = ChunkSupervisor(
+                    lambda: create_pool(*pool_args), max_pending,
+                    self.chunk_timeout, self.max_retries, self.retry_backoff,
+                    self.max_worker_rss)
+                with time('processed chunks'):
+                    cnt = self._process_results(
+                        supervisor(tasks), n_chunks, spans, chunker)
+            else:
+                with create_pool(*pool_args) as p:
+                    with time('processed chunks'):
+                        cnt = self._process_results(
+                            imap_bounded(p, _process_chunk, tasks,
+                                         self.max_pending),
+                            n_chunks, spans, chunker)
+        finally:
+            # workers in this process share the module's resident stashes
+            _WORKER_STASHES.pop(self.name, None)
+        return cnt
+
+    def _process_results(self, results: iter, n_chunks: int,
+                         spans: Dict[int, Tuple[int, int]],
+                         chunker: AdaptiveChunker) -> int:
+        """Report progress and record the chunk results in the manifest as they
+        finish, then mark the manifest complete if all succeeded.
+
+        :param results: the ``ChunkResult`` instances from the workers
+        :param n_chunks: the number of chunks to process if known
+        :param spans: the ``(offset, size)`` of each chunk by chunk ID
+        :param chunker: given the time taken by each chunk if not ``None``
+        :raises ValueError: if any chunk failed every attempt given by a
+                            ``ChunkSupervisor`` and isn't quarantined
+
+        """
+        reporter = self._create_reporter()
+        reporter.start(n_chunks)
+        self.last_progress = reporter.progress
+        cnt = 0
+        failed = []
+        self.quarantined = []
+        try:
+            for res in results:
+                offset, size = spans.pop(res.chunk_id)
+                if self.manifest is not None:
+                    self.manifest.record(res.chunk_id, offset, size,
+                                         res.count, res.error,
+                                         self.quarantine)
+                if res.error is None:
+                    cnt += res.count
+                    if chunker is not None:
+                        chunker.observe(size, res.elapsed)
+                elif self.quarantine:
+                    logger.error(f'quarantined chunk {res.chunk_id} of ' +
+                                 f'{size} items at {offset}: {res.error}')
+                    self.quarantined.append(res)
+                else:
+                    failed.append(res.chunk_id)
+                reporter.update(res)
+                self._notify()
+        finally:
+            reporter.finish()
+        if len(self.quarantined) > 0:
+            ids = sorted(map(lambda r: r.chunk_id, self.quarantined))
+            logger.warning(f'{len(ids)} chunk(s) quarantined: {ids}')
+        if len(failed) > 0:
+            raise ValueError(f'{len(failed)} chunk(s) failed (processed ' +
+                             f'{cnt} items), which are retried on the next ' +
+                             f'prime: {sorted(failed)}')
+        if self.manifest is not None:
+            self.manifest.mark_complete()
         return cnt
 
     def prime(self):
@@ -182,6 +1917,9 @@ class MultiProcessStash(PreemptiveStash, metaclass=ABCMeta):
         generate the data and process in children processes.
 
         """
+        if self.background:
+            self._prime_background()
+            return
         has_data = self.has_data
         logger.debug(f'asserting data: {has_data}')
         if not has_data:
@@ -189,14 +1927,104 @@ class MultiProcessStash(PreemptiveStash, metaclass=ABCMeta):
                 self._spawn_work()
             self._reset_has_data()
 
+    @property
+    def priming(self) -> bool:
+        "Whether the stash is priming in the background."
+        thread = self._prime_thread
+        return thread is not None and thread.is_alive()
+
+    def _prime_background(self):
+        """Start priming in a background thread unless the data exists or it is
+        already priming.
+
+        """
+        with self._prime_lock:
+            if self.priming or self.has_data:
+                return
+            self._prime_error = None
+            while not self._urgent.empty():
+                self._urgent.get_nowait()
+            self._prime_thread = threading.Thread(
+                target=self._prime_run, daemon=True,
+                name=f'{self.name}-prime')
+            self._prime_thread.start()
+
+    def _prime_run(self):
+        try:
+            with time('spawining work in {self}'):
+                self._spawn_work()
+        except Exception as e:
+            logger.error(f'background priming failed: {e}', exc_info=True)
+            self._prime_error = e
+        finally:
+            self._reset_has_data()
+            self._notify()
+
+    def _notify(self):
+        "Wake threads waiting on keys created by the background priming."
+        with self._prime_cond:
+            self._prime_cond.notify_all()
+
+    def join(self, timeout: float = None):
+        """Wait for background priming to finish.
+
+        :param timeout: the most seconds to wait
+        :raises ValueError: if the priming failed
+
+        """
+        thread = self._prime_thread
+        if thread is not None:
+            thread.join(timeout)
+        if self._prime_error is not None:
+            raise ValueError(f'priming failed: {self._prime_error}') \
+                from self._prime_error
+
+    def _prioritize(self, name: str):
+        "Move the data item that creates key ``name`` to the front of the queue."
+        idx = self._key_data_index(name)
+        if idx is not None:
+            self._urgent.put(idx)
+
+    def _load_pending(self, name: str):
+        """Load key ``name`` while priming in the background, which waits until it
+        is created or priming finishes.
+
+        """
+        inst = self.delegate.load(name)
+        if inst is None:
+            self._prioritize(name)
+            with self._prime_cond:
+                while inst is None and self.priming:
+                    self._prime_cond.wait(1)
+                    inst = self.delegate.load(name)
+            if inst is None:
+                self.join()
+                inst = self.delegate.load(name)
+        return inst
+
+    def clear(self):
+        if self.manifest is not None and self.manifest.exists:
+            # clear partially primed data without priming the rest
+            self.delegate.clear()
+            self.manifest.clear()
+            self._reset_has_data()
+        else:
+            super(MultiProcessStash, self).clear()
+
     def get(self, name: str, default=None):
         self.prime()
+        if self.priming:
+            inst = self._load_pending(name)
+            return default if inst is None else inst
         return super(MultiProcessStash, self).get(name, default)
 
     def load(self, name: str):
         self.prime()
+        if self.priming:
+            return self._load_pending(name)
         return super(MultiProcessStash, self).load(name)
 
     def keys(self):
         self.prime()
+        self.join()
         return super(MultiProcessStash, self).keys()
@@ -7,15 +7,35 @@ import logging
 from typing import List, Callable
 from abc import abstractmethod, ABC, ABCMeta
 import sys
+import os
 import re
+import inspect
 import itertools as it
 import parse
 from copy import copy
 import pickle
+import json
 import time as tm
 from pathlib import Path
 import shelve as sh
+import zlib
+import math
+import hashlib
+import threading
+import queue
+import atexit
+import weakref
+from bisect import bisect_left, bisect_right
+from contextlib import ExitStack
+from collections import deque, OrderedDict
+from concurrent.futures import (
+    Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+)
 import zensols.actioncli.time as time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
@@ -366,6 +386,37 @@ class resource(object):
         return wrapped
 
 
+class file_lock(object):
+    """Object used with a ``with`` scope that holds an exclusive advisory lock on
+    a file, which is created if it doesn't exist, across processes.  This
+    blocks until the lock is acquired.
+
+    with file_lock(Path('some.lock')):
+        ...
+
+    """
+    def __init__(self, path: Path):
+        if fcntl is None:
+            raise OSError('file locks are not supported on this platform')
+        self.path = path
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except Exception as e:
+            os.close(self.fd)
+            raise e
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+
+
 class chunks(object):
     """An iterable that chunks any other iterable in to chunks.  Each element
     returned is a list of elemnets of the given size or smaller.  That element
@@ -402,6 +453,67 @@ class chunks(object):
         return ds
 
 
+class prefetch(object):
+    """An iterable that loads the items of a stash on a pool of threads, keeping
+    up to ``max_pending`` loads in flight, and returns each as a key/value
+    tuple.  This is useful for I/O bound stashes (i.e. a ``DirectoryStash`` on
+    network storage) where loading one key at a time serializes all the
+    latency.
+
+    Items are loaded with the stash's ``__getitem__`` method, so the stash (or
+    its delegate) must be safe to use across threads.  Wrap it in a
+    ``ConcurrentStash`` if not.
+
+    """
+    def __init__(self, stash, keys: iter = None, n_workers: int = 4,
+                 ordered: bool = True, max_pending: int = None):
+        """Initialize.
+
+        :param stash: the stash from which to load items
+        :param keys: the keys to load, which defaults to all keys of ``stash``
+        :param n_workers: the number of threads used to load items
+        :param ordered: if ``True`` return items in key order, otherwise in
+                        the order in which they finish loading
+        :param max_pending: the maximum number of items loading or loaded but
+                            not yet returned, which caps the memory used;
+                            defaults to twice ``n_workers``
+
+        """
+        self.stash = stash
+        self.keys = keys
+        self.n_workers = n_workers
+        self.ordered = ordered
+        if max_pending is None:
+            max_pending = n_workers * 2
+        self.max_pending = max(max_pending, 1)
+
+    def _load(self, key):
+        return (key, self.stash.__getitem__(key))
+
+    def __iter__(self):
+        keys = iter(self.stash.keys() if self.keys is None else self.keys)
+        pending = deque() if self.ordered else set()
+        add = pending.append if self.ordered else pending.add
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            try:
+                while True:
+                    for key in it.islice(
+                            keys, self.max_pending - len(pending)):
+                        add(executor.submit(self._load, key))
+                    if len(pending) == 0:
+                        break
+                    if self.ordered:
+                        yield pending.popleft().result()
+                    else:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            pending.remove(future)
+                            yield future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
 # collections
 class Stash(ABC):
     """Pure virtual classes that represents CRUDing data that uses ``dict``
@@ -433,6 +545,21 @@ class Stash(ABC):
         else:
             return ret
 
+    def load_batch(self, names: List[str]) -> list:
+        """Load the data values of each key in ``names`` in the same order.
+        Stashes that can load many items more efficiently than one at a time
+        override this method.
+
+        """
+        return list(map(self.load, names))
+
+    def dump_batch(self, items: iter):
+        """Persist each key/value tuple in iterable ``items``.
+
+        """
+        for name, inst in items:
+            self.dump(name, inst)
+
     @abstractmethod
     def exists(self, name: str) -> bool:
         """Return ``True`` if data with key ``name`` exists.
@@ -459,7 +586,7 @@ class Stash(ABC):
         *Important*: Exercise caution with this method, of course.
 
         """
-        for k in self.keys():
+        for k in tuple(self.keys()):
             self.delete(k)
 
     @abstractmethod
@@ -473,14 +600,32 @@ class Stash(ABC):
         "Return an iterable of groups of keys, each of size at least ``n``."
         return chunks(self.keys(), n)
 
-    def values(self):
+    def values(self, n_workers: int = 0, ordered: bool = True,
+               max_pending: int = None):
         """Return the values in the hash.
 
+        :see: items
+
         """
+        if n_workers > 0:
+            return map(lambda x: x[1],
+                       self.items(n_workers, ordered, max_pending))
         return map(lambda k: self.__getitem__(k), self.keys())
 
-    def items(self):
-        """Return an iterable of all stash items."""
+    def items(self, n_workers: int = 0, ordered: bool = True,
+              max_pending: int = None):
+        """Return an iterable of all stash items.
+
+        :param n_workers: if greater than 0, load items on this many threads
+                          (see ``prefetch``), otherwise load them one at a time
+        :param ordered: if ``True`` return items in key order, otherwise in
+                        the order in which they finish loading
+        :param max_pending: the maximum number of items loading or waiting to
+                            be returned
+
+        """
+        if n_workers > 0:
+            return prefetch(self, None, n_workers, ordered, max_pending)
         return map(lambda k: (k, self.__getitem__(k)), self.keys())
 
     def __getitem__(self, key):
@@ -645,17 +790,104 @@ class FactoryStash(PreemptiveStash):
     """A stash that defers to creation of new items to another ``factory`` stash.
 
     """
-    def __init__(self, delegate, factory, enable_preemptive=True):
+    def __init__(self, delegate, factory, enable_preemptive=True,
+                 n_workers: int = 0, use_processes: bool = False,
+                 async_dump: bool = False, dump_queue_size: int = 100,
+                 lock_path: Path = None):
         """Initialize.
 
         :param delegate: the stash used for persistence
         :type delegate: Stash
         :param factory: the stash used to create using ``load`` and ``keys``
         :type factory: Stash
+        :param n_workers: the number of workers used to create missing items
+                          in ``load_batch`` and ``create_batch``, or 0 to
+                          create them serially on the calling thread
+        :param use_processes: if ``True`` create items in child processes
+                              instead of threads, in which case ``factory``
+                              must be picklable
+        :param async_dump: if ``True`` persist items to the delegate on a
+                           background thread so created items are returned
+                           without waiting on the write; use ``flush`` or
+                           ``close`` to wait for pending writes
+        :param dump_queue_size: the number of items waiting to be written at
+                                which ``dump`` blocks
+        :param lock_path: if given, a directory of per key lock files used so
+                          only one process (sharing the delegate) creates
+                          each missing item while the others wait and then
+                          load it; created items are then persisted by
+                          ``load``, and a key's lock file is removed once its
+                          item is persisted; the delegate's ``dump`` must
+                          replace items atomically (i.e. ``DirectoryStash``)
         """
         super(FactoryStash, self).__init__(delegate)
         self.factory = factory
         self.enable_preemptive = enable_preemptive
+        self.n_workers = n_workers
+        self.use_processes = use_processes
+        self.async_dump = async_dump
+        self.dump_queue_size = dump_queue_size
+        self.lock_path = lock_path
+        self._init_writer()
+
+    def _init_writer(self):
+        self._writer = None
+        self._write_error = None
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._write_queue = queue.Queue(self.dump_queue_size)
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_pending, name=f'{self}-writer',
+                daemon=True)
+            self._writer.start()
+            atexit.register(FactoryStash._flush_ref, weakref.ref(self))
+
+    @staticmethod
+    def _flush_ref(ref):
+        stash = ref()
+        if stash is not None:
+            stash.flush()
+
+    def _write_pending(self):
+        """Dump items from the queue to the delegate until the ``None`` sentinel.
+
+        """
+        while True:
+            entry = self._write_queue.get()
+            try:
+                if entry is None:
+                    break
+                name, inst = entry
+                self.delegate.dump(name, inst)
+                with self._pending_lock:
+                    if self._pending.get(name) is inst:
+                        del self._pending[name]
+            except Exception as e:
+                logger.error(f'could not persist {name}: {e}')
+                if self._write_error is None:
+                    self._write_error = e
+            finally:
+                self._write_queue.task_done()
+
+    def _pending_item(self, name: str):
+        with self._pending_lock:
+            return self._pending.get(name)
+
+    def flush(self):
+        """Wait for all pending asynchronous writes to reach the delegate.
+
+        :raises: the first error raised by the delegate while writing
+
+        """
+        if self._writer is not None:
+            self._write_queue.join()
+            err = self._write_error
+            if err is not None:
+                self._write_error = None
+                raise err
 
     def _calculate_has_data(self) -> bool:
         if self.enable_preemptive:
@@ -663,16 +895,166 @@ class FactoryStash(PreemptiveStash):
         else:
             return False
 
+    def _key_lock(self, name: str) -> file_lock:
+        "Return the cross process lock for creating item ``name``."
+        fname = re.sub(r'[ /\\]', '_', str(name))
+        return file_lock(self.lock_path / f'{fname}.lock')
+
+    def _create_locked(self, name: str):
+        """Create and persist item ``name`` unless another process did so while we
+        waited on the key's lock.
+
+        """
+        with self._key_lock(name) as lock:
+            item = self.delegate.load(name)
+            if item is None:
+                item = self.factory.load(name)
+                if item is not None:
+                    self.delegate.dump(name, item)
+                    self._set_has_data(True)
+            if item is not None:
+                # processes that later lock a new file find the item persisted
+                try:
+                    lock.path.unlink()
+                except FileNotFoundError:
+                    pass
+        return item
+
     def load(self, name: str):
-        item = super(FactoryStash, self).load(name)
+        item = None
+        if self.async_dump:
+            item = self._pending_item(name)
         if item is None:
-            self._reset_has_data()
-            item = self.factory.load(name)
+            item = super(FactoryStash, self).load(name)
+        if item is None:
+            if self.lock_path is None:
+                item = self.factory.load(name)
+            else:
+                item = self._create_locked(name)
+        return item
+
+    def exists(self, name: str) -> bool:
+        if self.async_dump and self._pending_item(name) is not None:
+            return True
+        return super(FactoryStash, self).exists(name)
+
+    def dump(self, name: str, inst):
+        if self.async_dump:
+            with self._pending_lock:
+                self._pending[name] = inst
+            self._start_writer()
+            self._write_queue.put((name, inst))
+        else:
+            super(FactoryStash, self).dump(name, inst)
+        self._set_has_data(True)
+
+    def delete(self, name=None):
+        self.flush()
+        super(FactoryStash, self).delete(name)
+
+    def clear(self):
+        self.flush()
+        super(FactoryStash, self).clear()
+
+    def close(self):
+        if self._writer is not None:
+            self.flush()
+            self._write_queue.put(None)
+            self._writer.join()
+            self._writer = None
+        return super(FactoryStash, self).close()
+
+    def __getitem__(self, key):
+        if self.lock_path is None:
+            return super(FactoryStash, self).__getitem__(key)
+        # items are persisted under the lock by load
+        item = self.load(key)
+        if item is None:
+            raise KeyError(key)
         return item
 
+    def __getstate__(self):
+        self.flush()
+        state = copy(self.__dict__)
+        for k in ('_writer _write_error _pending _pending_lock ' +
+                  '_write_queue').split():
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_writer()
+
+    def _create_items(self, names: List[str]) -> list:
+        """Create the items of ``names`` with the factory using the configured
+        workers.
+
+        """
+        create = self.factory.load if self.lock_path is None \
+            else self._create_locked
+        if self.n_workers <= 0 or len(names) <= 1:
+            return list(map(create, names))
+        if self.use_processes:
+            executor = ProcessPoolExecutor(self.n_workers)
+            chunksize = max(len(names) // (self.n_workers * 4), 1)
+        else:
+            executor = ThreadPoolExecutor(self.n_workers)
+            chunksize = 1
+        with executor:
+            return list(executor.map(create, names, chunksize=chunksize))
+
+    def load_batch(self, names: List[str]) -> list:
+        """Load each item in ``names``, creating and persisting the missing items in
+        parallel.
+
+        """
+        names = tuple(names)
+        items = self.delegate.load_batch(names)
+        if self.async_dump:
+            for i, name in enumerate(names):
+                if items[i] is None:
+                    items[i] = self._pending_item(name)
+        missing = tuple(filter(lambda i: items[i] is None,
+                               range(len(names))))
+        if len(missing) > 0:
+            created = self._create_items(tuple(map(lambda i: names[i],
+                                                   missing)))
+            dumps = []
+            for i, item in zip(missing, created):
+                items[i] = item
+                if item is not None:
+                    dumps.append((names[i], item))
+            # items created under a lock are already persisted
+            if len(dumps) > 0 and self.lock_path is None:
+                self.delegate.dump_batch(dumps)
+                self._set_has_data(True)
+        return items
+
+    def create_batch(self, names: List[str] = None) -> int:
+        """Create and persist every item in ``names`` that isn't yet in the
+        delegate.
+
+        :param names: the keys of the items to create, which defaults to all
+                      the factory's keys
+        :return: the number of items created
+
+        """
+        if names is None:
+            names = self.factory.keys()
+        missing = tuple(filter(lambda n: not self.exists(n), names))
+        with time('created {cnt} items'):
+            cnt = sum(map(lambda x: x is not None,
+                          self.load_batch(missing)))
+        return cnt
+
     def keys(self) -> List[str]:
         if self.has_data:
             ks = super(FactoryStash, self).keys()
+            if self.async_dump:
+                with self._pending_lock:
+                    pending = tuple(self._pending.keys())
+                if len(pending) > 0:
+                    ks = tuple(OrderedDict.fromkeys(it.chain(ks, pending)))
         else:
             ks = self.factory.keys()
         return ks
@@ -683,15 +1065,81 @@ class OneShotFactoryStash(PreemptiveStash, metaclass=ABCMeta):
     is generated by the worker and dumped to the delegate.
 
     """
-    def __init__(self, worker, *args, **kwargs):
+    def __init__(self, worker, *args, chunk_size: int = 0,
+                 n_workers: int = 0, progress_path: Path = None, **kwargs):
         """Initialize the stash.
 
         :param worker: either a callable (i.e. function) or an interable that
-                       return tuples or lists of (key, object)
+                       return tuples or lists of (key, object); a callable
+                       with a ``start`` parameter is given the number of
+                       items already dumped when priming resumes
+        :param chunk_size: the number of items dumped to the delegate as a
+                           batch, after which progress is recorded; 0 dumps
+                           one item at a time
+        :param n_workers: the number of threads used to dump each batch, or 0
+                          to dump on the calling thread
+        :param progress_path: if given, a file used to record the number of
+                              items dumped after each batch and whether
+                              priming completed; the stash then only has
+                              data once complete, and a restarted priming
+                              skips the items already dumped, which requires
+                              the worker to generate items in the same order;
+                              workers without a ``start`` parameter still
+                              generate (and then discard) the skipped items
 
         """
         super(OneShotFactoryStash, self).__init__(*args, **kwargs)
         self.worker = worker
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers
+        self.progress_path = progress_path
+
+    def _read_progress(self) -> dict:
+        """Return the persisted priming progress.
+
+        """
+        if self.progress_path is not None and self.progress_path.is_file():
+            with open(self.progress_path) as f:
+                return json.load(f)
+        return {'n_items': 0, 'complete': False}
+
+    def _write_progress(self, n_items: int, complete: bool):
+        """Persist the priming progress replacing the file atomically so a crash
+        never leaves a partial file.
+
+        """
+        path = self.progress_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.parent / f'{path.name}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'n_items': n_items, 'complete': complete}, f)
+        os.replace(tmp_path, path)
+
+    def _calculate_has_data(self) -> bool:
+        if self.progress_path is None:
+            return super(OneShotFactoryStash, self)._calculate_has_data()
+        if not hasattr(self, '_has_data'):
+            self._has_data = self._read_progress()['complete']
+        return self._has_data
+
+    def _dump_batch(self, batch: list, executor: ThreadPoolExecutor):
+        if executor is None:
+            self.delegate.dump_batch(batch)
+        else:
+            tuple(executor.map(lambda x: self.delegate.dump(*x), batch))
+
+    def _worker_starts(self) -> bool:
+        """Return whether the worker is a callable that takes the number of items to
+        skip as its ``start`` parameter.
+
+        """
+        if not callable(self.worker):
+            return False
+        try:
+            params = inspect.signature(self.worker).parameters
+        except (TypeError, ValueError):
+            return False
+        return 'start' in params
 
     def _process_work(self):
         """Invoke the worker to generate the data and dump it to the delegate.
@@ -699,12 +1147,35 @@ class OneShotFactoryStash(PreemptiveStash, metaclass=ABCMeta):
         """
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f'processing with {type(self.worker)}')
-        if callable(self.worker):
-            itr = self.worker()
+        if self.progress_path is None:
+            n_items = 0
+        else:
+            n_items = self._read_progress()['n_items']
+        if n_items > 0:
+            logger.info(f'resuming after {n_items} items')
+        if self._worker_starts():
+            itr = self.worker(start=n_items)
         else:
-            itr = self.worker
-        for id, obj in itr:
-            self.delegate.dump(id, obj)
+            if callable(self.worker):
+                itr = self.worker()
+            else:
+                itr = self.worker
+            if n_items > 0:
+                itr = it.islice(itr, n_items, None)
+        executor = None
+        if self.n_workers > 0:
+            executor = ThreadPoolExecutor(self.n_workers)
+        try:
+            for batch in chunks(itr, max(self.chunk_size, 1)):
+                self._dump_batch(batch, executor)
+                n_items += len(batch)
+                if self.progress_path is not None:
+                    self._write_progress(n_items, False)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if self.progress_path is not None:
+            self._write_progress(n_items, True)
 
     def prime(self):
         has_data = self.has_data
@@ -715,6 +1186,16 @@ class OneShotFactoryStash(PreemptiveStash, metaclass=ABCMeta):
                 self._process_work()
             self._reset_has_data()
 
+    def clear(self):
+        if self.progress_path is None:
+            super(OneShotFactoryStash, self).clear()
+        else:
+            # clear partially primed data without priming
+            self.delegate.clear()
+        if self.progress_path is not None and self.progress_path.is_file():
+            self.progress_path.unlink()
+        self._reset_has_data()
+
     def get(self, name: str, default=None):
         self.prime()
         return super(OneShotFactoryStash, self).get(name, default)
@@ -728,23 +1209,134 @@ class OneShotFactoryStash(PreemptiveStash, metaclass=ABCMeta):
         return super(OneShotFactoryStash, self).keys()
 
 
+def _delegate_version(delegate: Stash):
+    """Return a value that changes when the keys of ``delegate`` change outside of
+    the stash wrapping it, or ``None`` if that can't be detected.
+
+    """
+    path = getattr(delegate, 'create_path', None)
+    if isinstance(path, Path):
+        try:
+            return path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+
 class OrderedKeyStash(DelegateStash):
     """Specify an ordering to how keys in a stash are returned.  This usually also
     has an impact on the order in which values are iterated since a call to get
     the keys determins it.
 
+    The sorted keys are cached and kept sorted as keys are dumped and deleted
+    through this stash.  The cache is rebuilt after ``invalidate`` is called
+    or, for delegates with a ``create_path`` directory (i.e.
+    ``DirectoryStash``), when the directory is modified by another stash.
+
     """
     def __init__(self, delegate: Stash, order_function: Callable = int):
         super(OrderedKeyStash, self).__init__(delegate)
         self.order_function = order_function
+        self._index = None
 
-    def keys(self) -> List[str]:
-        keys = super(OrderedKeyStash, self).keys()
+    def _sort_key(self, name: str):
         if self.order_function:
-            keys = sorted(keys, key=self.order_function)
-        else:
-            keys = sorted(keys)
-        return keys
+            return self.order_function(name)
+        return name
+
+    def invalidate(self):
+        "Force the sorted keys to be read from the delegate on next access."
+        self._index = None
+
+    def _sorted_index(self) -> tuple:
+        """Return the sort keys and the keys as parallel sorted lists.
+
+        """
+        version = _delegate_version(self.delegate)
+        if self._index is None or self._index[2] != version:
+            keys = super(OrderedKeyStash, self).keys()
+            pairs = sorted(map(lambda k: (self._sort_key(k), k), keys),
+                           key=lambda x: x[0])
+            self._index = ([p[0] for p in pairs], [p[1] for p in pairs],
+                           version)
+        return self._index
+
+    def _find(self, name: str) -> int:
+        """Return the position of ``name`` in the index or -1 if not found.
+
+        """
+        sort_keys, keys, _ = self._index
+        sk = self._sort_key(name)
+        i = bisect_left(sort_keys, sk)
+        while i < len(sort_keys) and sort_keys[i] == sk:
+            if keys[i] == name:
+                return i
+            i += 1
+        return -1
+
+    def _update_version(self):
+        sort_keys, keys, _ = self._index
+        self._index = (sort_keys, keys, _delegate_version(self.delegate))
+
+    def dump(self, name: str, inst):
+        index = self._index
+        if index is not None:
+            index = self._sorted_index()
+        super(OrderedKeyStash, self).dump(name, inst)
+        if index is not None:
+            if self._find(name) < 0:
+                sort_keys, keys, _ = index
+                i = bisect_right(sort_keys, self._sort_key(name))
+                sort_keys.insert(i, self._sort_key(name))
+                keys.insert(i, name)
+            # overwriting an item still modifies the delegate's directory
+            self._update_version()
+
+    def delete(self, name=None):
+        if name is None:
+            super(OrderedKeyStash, self).delete()
+            self.invalidate()
+            return
+        index = self._index
+        if index is not None:
+            index = self._sorted_index()
+        super(OrderedKeyStash, self).delete(name)
+        if index is not None:
+            i = self._find(name)
+            if i >= 0:
+                del index[0][i]
+                del index[1][i]
+            self._update_version()
+
+    def clear(self):
+        super(OrderedKeyStash, self).clear()
+        self.invalidate()
+
+    def keys(self) -> List[str]:
+        return tuple(self._sorted_index()[1])
+
+    def keys_between(self, start: str = None, end: str = None,
+                     offset: int = 0, limit: int = None) -> List[str]:
+        """Return the sorted keys from ``start`` to ``end`` inclusive, which is
+        useful for paging through ordered data.
+
+        :param start: the first key, or ``None`` to start at the first key
+        :param end: the last key, or ``None`` to end at the last key
+        :param offset: the number of keys in the range to skip
+        :param limit: the maximum number of keys to return
+
+        """
+        sort_keys, keys, _ = self._sorted_index()
+        lo = 0 if start is None else \
+            bisect_left(sort_keys, self._sort_key(start))
+        hi = len(keys) if end is None else \
+            bisect_right(sort_keys, self._sort_key(end))
+        lo = min(lo + offset, hi)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return tuple(keys[lo:hi])
+
+    def __len__(self):
+        return len(self._sorted_index()[1])
 
 
 class DictionaryStash(DelegateStash):
@@ -832,6 +1424,820 @@ class CacheStash(DelegateStash):
         self.cache_stash.clear()
 
 
+class ConcurrentStash(DelegateStash):
+    """Make any delegate stash safe to use across threads.
+
+    Operations on a key are guarded by one of ``n_stripes`` locks chosen by
+    the hash of the key, so threads working on different keys rarely contend.
+    Concurrent loads of the same key are coalesced (single-flight) so the
+    delegate loads (or creates with a ``FactoryStash``) the item only once and
+    every waiting thread gets that same result.  Only ``clear`` and ``close``
+    lock the entire stash; ``keys`` is read without locking so a large
+    delegate (i.e. a ``DirectoryStash``) doesn't block other threads, and may
+    not reflect dumps and deletes happening at the same time.
+
+    Stashes that share a single resource across keys, such as
+    ``ShelveStash``, should be wrapped with ``n_stripes=1``.
+
+    """
+    def __init__(self, delegate: Stash, n_stripes: int = 64):
+        """Initialize.
+
+        :param delegate: the stash to guard
+        :param n_stripes: the number of locks keys are distributed across
+
+        """
+        super(ConcurrentStash, self).__init__(delegate)
+        self.n_stripes = n_stripes
+        self._init_locks()
+
+    def _init_locks(self):
+        n = self.n_stripes
+        self._locks = tuple(threading.RLock() for _ in range(n))
+        self._flight_locks = tuple(threading.Lock() for _ in range(n))
+        self._flights = tuple({} for _ in range(n))
+
+    def _stripe(self, name: str) -> int:
+        "Return the index of the lock stripe for key ``name``."
+        return hash(name) % self.n_stripes
+
+    def _lock_all(self) -> ExitStack:
+        """Return a context manager that acquires all the stripe locks in order.
+
+        """
+        stack = ExitStack()
+        for lock in self._locks:
+            stack.enter_context(lock)
+        return stack
+
+    def _single_flight(self, op: str, name: str, fn: Callable):
+        """Invoke ``fn`` for operation ``op`` on key ``name`` unless another thread
+        is already doing so, in which case wait for and return its result.
+
+        """
+        idx = self._stripe(name)
+        key = (op, name)
+        with self._flight_locks[idx]:
+            flight = self._flights[idx].get(key)
+            leader = flight is None
+            if leader:
+                flight = Future()
+                self._flights[idx][key] = flight
+        if not leader:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'waiting on in flight {op}: {name}')
+            return flight.result()
+        try:
+            flight.set_result(fn())
+        except BaseException as e:
+            flight.set_exception(e)
+            raise e
+        finally:
+            with self._flight_locks[idx]:
+                del self._flights[idx][key]
+        return flight.result()
+
+    def _locked_load(self, name: str):
+        with self._locks[self._stripe(name)]:
+            return self.delegate.load(name)
+
+    def load(self, name: str):
+        return self._single_flight(
+            'load', name, lambda: self._locked_load(name))
+
+    def get(self, name: str, default=None):
+        with self._locks[self._stripe(name)]:
+            return self.delegate.get(name, default)
+
+    def exists(self, name: str) -> bool:
+        with self._locks[self._stripe(name)]:
+            return self.delegate.exists(name)
+
+    def dump(self, name: str, inst):
+        with self._locks[self._stripe(name)]:
+            return self.delegate.dump(name, inst)
+
+    def delete(self, name=None):
+        if name is None:
+            with self._lock_all():
+                self.delegate.delete(name)
+        else:
+            with self._locks[self._stripe(name)]:
+                self.delegate.delete(name)
+
+    def keys(self) -> List[str]:
+        return tuple(self.delegate.keys())
+
+    def clear(self):
+        with self._lock_all():
+            self.delegate.clear()
+
+    def close(self):
+        with self._lock_all():
+            return self.delegate.close()
+
+    def __getitem__(self, key):
+        # coalesce the check, create and dump so an item created by a factory
+        # is persisted once
+        sup = super(ConcurrentStash, self)
+        return self._single_flight('item', key, lambda: sup.__getitem__(key))
+
+    def __getstate__(self):
+        state = copy(self.__dict__)
+        for k in '_locks _flight_locks _flights'.split():
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_locks()
+
+
+class ShardedStash(CloseableStash):
+    """Stripe one logical stash across several delegate stashes (i.e. one
+    ``DirectoryStash`` per disk).  Each key is routed to its shard by a stable
+    hash of the key, so it maps to the same delegate across processes and
+    runs.  Methods that span all shards (``keys``, ``len``, ``clear`` and the
+    batch methods) are run on the shards in parallel threads.
+
+    """
+    def __init__(self, delegates: List[Stash], n_workers: int = None):
+        """Initialize.
+
+        :param delegates: the stashes, one per shard, that persist the data
+        :param n_workers: the number of threads used for operations that span
+                          shards, which defaults to the number of shards
+
+        """
+        delegates = tuple(delegates)
+        if len(delegates) == 0:
+            raise ValueError('sharded stash needs at least one delegate')
+        for delegate in delegates:
+            if not isinstance(delegate, Stash):
+                raise ValueError(f'not a stash: {delegate}')
+        self.delegates = delegates
+        self.n_workers = len(delegates) if n_workers is None else n_workers
+
+    @staticmethod
+    def shard_index(name: str, n_shards: int) -> int:
+        """Return the index of the shard of key ``name`` out of ``n_shards``.
+
+        """
+        return zlib.crc32(str(name).encode('utf-8')) % n_shards
+
+    def _shard(self, name: str) -> Stash:
+        "Return the delegate that stores key ``name``."
+        return self.delegates[self.shard_index(name, len(self.delegates))]
+
+    def _fan_out(self, fn: Callable, args: iter = None) -> list:
+        """Invoke ``fn`` with each shard (or each of ``args``) in parallel and
+        return the results in shard order.
+
+        """
+        args = self.delegates if args is None else args
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            return list(executor.map(fn, args))
+
+    def _group(self, names: iter) -> List[List[str]]:
+        "Return ``names`` grouped by shard index."
+        groups = tuple([] for _ in self.delegates)
+        for name in names:
+            groups[self.shard_index(name, len(self.delegates))].append(name)
+        return groups
+
+    def load(self, name: str):
+        return self._shard(name).load(name)
+
+    def get(self, name: str, default=None):
+        return self._shard(name).get(name, default)
+
+    def exists(self, name: str) -> bool:
+        return self._shard(name).exists(name)
+
+    def dump(self, name: str, inst):
+        self._shard(name).dump(name, inst)
+
+    def delete(self, name=None):
+        if name is None:
+            self._fan_out(lambda s: s.delete())
+        else:
+            self._shard(name).delete(name)
+
+    def load_batch(self, names: List[str]) -> list:
+        names = tuple(names)
+        groups = self._group(names)
+        loaded = self._fan_out(
+            lambda x: zip(x[1], x[0].load_batch(x[1])),
+            zip(self.delegates, groups))
+        by_name = dict(it.chain.from_iterable(loaded))
+        return list(map(lambda n: by_name[n], names))
+
+    def dump_batch(self, items: iter):
+        groups = tuple([] for _ in self.delegates)
+        for name, inst in items:
+            groups[self.shard_index(name, len(self.delegates))].append(
+                (name, inst))
+        self._fan_out(lambda x: x[0].dump_batch(x[1]),
+                      zip(self.delegates, groups))
+
+    def keys(self) -> List[str]:
+        return tuple(it.chain.from_iterable(
+            self._fan_out(lambda s: tuple(s.keys()))))
+
+    def clear(self):
+        self._fan_out(lambda s: s.clear())
+
+    def close(self):
+        for delegate in self.delegates:
+            if isinstance(delegate, CloseableStash):
+                delegate.close()
+
+    def __len__(self):
+        return sum(self._fan_out(len))
+
+    @staticmethod
+    def _same_storage(a: Stash, b: Stash) -> bool:
+        """Return whether stashes ``a`` and ``b`` persist to the same place, such as
+        two ``DirectoryStash`` instances on the same directory.
+
+        """
+        if a is b:
+            return True
+        apath = getattr(a, 'create_path', None)
+        bpath = getattr(b, 'create_path', None)
+        return isinstance(apath, Path) and isinstance(bpath, Path) and \
+            type(a) == type(b) and apath.resolve() == bpath.resolve() and \
+            getattr(a, 'pattern', None) == getattr(b, 'pattern', None)
+
+    def reshard(self, delegates: List[Stash]) -> 'ShardedStash':
+        """Move the data of this stash across a new set of shards.  Items are moved
+        (dumped to their new shard and then deleted from their old one) only
+        when their shard changes, so delegates may be shared between the old
+        and new shards, such as when adding a disk.  Delegates are shared when
+        they are the same instance or persist to the same ``create_path`` (see
+        ``_same_storage``).
+
+        :param delegates: the stashes of the new shards
+        :return: the new stash, which replaces this one
+
+        """
+        target = self.__class__(delegates, self.n_workers)
+
+        def move(src: Stash) -> int:
+            cnt = 0
+            for name in tuple(src.keys()):
+                dst = target._shard(name)
+                if not self._same_storage(dst, src):
+                    dst.dump(name, src.load(name))
+                    src.delete(name)
+                    cnt += 1
+            return cnt
+
+        with time('moved {cnt} items while resharding'):
+            cnt = sum(self._fan_out(move))
+        return target
+
+
+class StashOperationStats(object):
+    """Counts, hits, bytes and a latency histogram for one operation (i.e.
+    ``load``) on an ``InstrumentedStash``.
+
+    """
+    BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1., 10.)
+    """The upper bound in seconds of each histogram bucket (the last bucket holds
+    anything slower).
+
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.hits = 0
+        self.has_hits = False
+        self.bytes = 0
+        self.elapsed = 0.
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def record(self, elapsed: float, hit: bool = None, n_bytes: int = 0):
+        """Record an invocation of the operation.
+
+        :param elapsed: the time in seconds it took to complete
+        :param hit: whether the data was found, or ``None`` for operations
+                    where this doesn't apply
+        :param n_bytes: the pickled size of the data loaded or dumped
+
+        """
+        self.count += 1
+        self.elapsed += elapsed
+        self.bytes += n_bytes
+        self.histogram[bisect_left(self.BUCKETS, elapsed)] += 1
+        if hit is not None:
+            self.has_hits = True
+            if hit:
+                self.hits += 1
+
+    @property
+    def hit_rate(self) -> float:
+        """Return the ratio of invocations that found data, or ``None`` if not
+        applicable.
+
+        """
+        if self.has_hits and self.count > 0:
+            return self.hits / self.count
+
+    def write(self, writer=sys.stdout, indent=0):
+        sp = ' ' * indent
+        avg = (self.elapsed / self.count) if self.count > 0 else 0
+        line = (f'{sp}{self.name}: count={self.count}, ' +
+                f'total={self.elapsed:.4f}s, avg={avg * 1e3:.3f}ms')
+        if self.bytes > 0:
+            line += f', bytes={self.bytes}'
+        if self.hit_rate is not None:
+            line += f', hit rate={self.hit_rate:.3f}'
+        writer.write(line + '\n')
+        bounds = tuple(map(lambda b: f'<={b:g}s', self.BUCKETS)) + \
+            (f'>{self.BUCKETS[-1]:g}s',)
+        hist = ', '.join(map(lambda x: f'{x[0]}: {x[1]}',
+                             filter(lambda x: x[1] > 0,
+                                    zip(bounds, self.histogram))))
+        if len(hist) > 0:
+            writer.write(f'{sp} latency: {hist}\n')
+
+
+class InstrumentedStash(DelegateStash):
+    """Records the count, latency histogram, pickled bytes and hit rate of the
+    ``load``, ``dump``, ``exists``, ``keys`` and ``delete`` calls on its
+    delegate.  Instances can be wrapped around each layer of a stash (see the
+    ``instrument`` parameter of ``StashFactory``), in which case ``write``
+    reports each layer nested in its parent.
+
+    Note that ``keys`` are read in to memory so the time to iterate over them
+    is included.
+
+    """
+    OPERATIONS = 'load dump exists keys delete'.split()
+
+    def __init__(self, delegate: Stash, name: str = None,
+                 measure_bytes: bool = True):
+        """Initialize.
+
+        :param delegate: the stash to instrument
+        :param name: the name used in the report, which defaults to the
+                     delegate's class name
+        :param measure_bytes: whether to pickle data loaded and dumped to
+                              record its size, which adds its own overhead
+
+        """
+        super(InstrumentedStash, self).__init__(delegate)
+        self.name = delegate.__class__.__name__ if name is None else name
+        self.measure_bytes = measure_bytes
+        self._stats_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Clear all recorded statistics."
+        with self._stats_lock:
+            self.stats = {op: StashOperationStats(op)
+                          for op in self.OPERATIONS}
+
+    def _size(self, inst) -> int:
+        if self.measure_bytes and inst is not None:
+            try:
+                return len(pickle.dumps(inst))
+            except Exception:
+                pass
+        return 0
+
+    def _record(self, op: str, t0: float, hit: bool = None, inst=None):
+        elapsed = tm.time() - t0
+        n_bytes = self._size(inst)
+        with self._stats_lock:
+            self.stats[op].record(elapsed, hit, n_bytes)
+
+    def load(self, name: str):
+        t0 = tm.time()
+        inst = self.delegate.load(name)
+        self._record('load', t0, inst is not None, inst)
+        return inst
+
+    def get(self, name: str, default=None):
+        t0 = tm.time()
+        inst = self.delegate.get(name)
+        self._record('load', t0, inst is not None, inst)
+        return default if inst is None else inst
+
+    def exists(self, name: str) -> bool:
+        t0 = tm.time()
+        exists = self.delegate.exists(name)
+        self._record('exists', t0, exists)
+        return exists
+
+    def dump(self, name: str, inst):
+        t0 = tm.time()
+        ret = self.delegate.dump(name, inst)
+        self._record('dump', t0, inst=inst)
+        return ret
+
+    def delete(self, name=None):
+        t0 = tm.time()
+        self.delegate.delete(name)
+        self._record('delete', t0)
+
+    def keys(self) -> List[str]:
+        t0 = tm.time()
+        keys = tuple(self.delegate.keys())
+        self._record('keys', t0)
+        return keys
+
+    def _children(self) -> iter:
+        """Return the ``InstrumentedStash`` instances that are the layers under this
+        one.
+
+        """
+        def find(obj, depth):
+            if isinstance(obj, InstrumentedStash):
+                yield obj
+            elif isinstance(obj, (tuple, list)):
+                for o in obj:
+                    yield from find(o, depth)
+            elif isinstance(obj, Stash) and depth < 10:
+                for o in obj.__dict__.values():
+                    yield from find(o, depth + 1)
+
+        return find(tuple(self.delegate.__dict__.values()), 0)
+
+    def write(self, writer=sys.stdout, indent=0):
+        """Write the statistics of this and every instrumented layer under it.
+
+        """
+        sp = ' ' * indent
+        writer.write(f'{sp}{self.name} ({self.delegate.__class__.__name__}):\n')
+        with self._stats_lock:
+            for op in self.OPERATIONS:
+                stats = self.stats[op]
+                if stats.count > 0:
+                    stats.write(writer, indent + 2)
+        for child in self._children():
+            child.write(writer, indent + 2)
+
+    def __getstate__(self):
+        state = copy(self.__dict__)
+        del state['_stats_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
+
+
+class TieredStash(CloseableStash):
+    """A stash of ordered tiers, fastest first, such as memory, then a
+    ``DirectoryStash`` on a local SSD, then one on bulk storage.  Each tier
+    except (usually) the last has a capacity in number of items.
+
+    Reads are served from the fastest tier that has the key and the item is
+    promoted to the first tier.  When a tier is over capacity its least
+    recently used items are demoted to the next tier.  An item demoted out of
+    the last tier (only if it has a capacity) is dropped.
+
+    This class is not thread safe across keys, so wrap it in a
+    ``ConcurrentStash`` with ``n_stripes=1`` if needed.
+
+    """
+    def __init__(self, tiers: List[Stash], capacities: List[int] = None,
+                 write_through: bool = True):
+        """Initialize.
+
+        :param tiers: the stashes of each tier ordered from fastest to slowest
+        :param capacities: the maximum number of items in each tier, where
+                           ``None`` is unbounded, which defaults to unbounded
+                           for all tiers
+        :param write_through: if ``True``, ``dump`` also persists the item to
+                              the last tier so no data is lost in volatile
+                              tiers
+
+        """
+        tiers = tuple(tiers)
+        if len(tiers) == 0:
+            raise ValueError('tiered stash needs at least one tier')
+        if capacities is None:
+            capacities = (None,) * len(tiers)
+        capacities = tuple(capacities)
+        if len(capacities) != len(tiers):
+            raise ValueError(f'expecting {len(tiers)} capacities but ' +
+                             f'got {len(capacities)}')
+        self.tiers = tiers
+        self.capacities = capacities
+        self.write_through = write_through
+        # key use order for each bounded tier, or None if unbounded
+        self._lru = tuple(map(
+            lambda x: None if x[1] is None else
+            OrderedDict.fromkeys(x[0].keys()), zip(tiers, capacities)))
+        self.reset_stats()
+
+    def reset_stats(self):
+        "Reset the per tier hit counts."
+        self.lookups = 0
+        self.hits = [0] * len(self.tiers)
+
+    @property
+    def hit_rates(self) -> List[float]:
+        """Return the ratio of loads served from each tier.
+
+        """
+        n = max(self.lookups, 1)
+        return tuple(map(lambda h: h / n, self.hits))
+
+    def _in_tier(self, i: int, name: str) -> bool:
+        lru = self._lru[i]
+        if lru is None:
+            return self.tiers[i].exists(name)
+        return name in lru
+
+    def _put(self, i: int, name: str, inst):
+        """Dump ``inst`` to tier ``i`` and demote the least recently used items
+        to lower tiers while over capacity.
+
+        """
+        self.tiers[i].dump(name, inst)
+        lru = self._lru[i]
+        if lru is not None:
+            lru[name] = True
+            lru.move_to_end(name)
+            while len(lru) > self.capacities[i]:
+                self._demote(i, next(iter(lru)))
+
+    def _demote(self, i: int, name: str):
+        "Move item ``name`` from tier ``i`` to tier ``i + 1``."
+        tier = self.tiers[i]
+        nxt = i + 1
+        if nxt < len(self.tiers) and not self._in_tier(nxt, name):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'demoting {name} to tier {nxt}')
+            self._put(nxt, name, tier.load(name))
+        tier.delete(name)
+        del self._lru[i][name]
+
+    def load(self, name: str):
+        self.lookups += 1
+        for i, tier in enumerate(self.tiers):
+            lru = self._lru[i]
+            if lru is not None and name not in lru:
+                continue
+            inst = tier.load(name)
+            if inst is not None:
+                self.hits[i] += 1
+                if i > 0:
+                    self._put(0, name, inst)
+                elif lru is not None:
+                    lru.move_to_end(name)
+                return inst
+
+    def exists(self, name: str) -> bool:
+        return any(map(lambda i: self._in_tier(i, name),
+                       range(len(self.tiers))))
+
+    def dump(self, name: str, inst):
+        last = len(self.tiers) - 1
+        # remove stale copies from the lower tiers
+        for i in range(1, len(self.tiers)):
+            if (i < last or not self.write_through) and \
+               self._in_tier(i, name):
+                self.tiers[i].delete(name)
+                if self._lru[i] is not None:
+                    del self._lru[i][name]
+        if self.write_through and last > 0:
+            self._put(last, name, inst)
+        self._put(0, name, inst)
+
+    def delete(self, name=None):
+        if name is None:
+            self.clear()
+            return
+        for i, tier in enumerate(self.tiers):
+            if self._in_tier(i, name):
+                tier.delete(name)
+                if self._lru[i] is not None:
+                    del self._lru[i][name]
+
+    def keys(self) -> List[str]:
+        return tuple(OrderedDict.fromkeys(it.chain.from_iterable(
+            map(lambda t: t.keys(), self.tiers))))
+
+    def clear(self):
+        for tier, lru in zip(self.tiers, self._lru):
+            tier.clear()
+            if lru is not None:
+                lru.clear()
+
+    def close(self):
+        for tier in self.tiers:
+            if isinstance(tier, CloseableStash):
+                tier.close()
+
+    def write(self, writer=sys.stdout, indent=0):
+        """Write the fill and hit rate of each tier.
+
+        """
+        sp = ' ' * indent
+        for i, (tier, rate) in enumerate(zip(self.tiers, self.hit_rates)):
+            lru = self._lru[i]
+            fill = '' if lru is None else \
+                f', items={len(lru)}/{self.capacities[i]}'
+            writer.write(f'{sp}tier {i} ({tier.__class__.__name__}): ' +
+                         f'hit rate={rate:.3f}{fill}\n')
+
+
+class BloomFilter(object):
+    """A space efficient probabilistic set of strings.  Membership tests have no
+    false negatives and false positives at about the rate given in the
+    initializer when no more than ``capacity`` items are added.
+
+    """
+    def __init__(self, capacity: int = 100000,
+                 false_positive_rate: float = 0.01):
+        """Initialize.
+
+        :param capacity: the number of items expected to be added
+        :param false_positive_rate: the desired probability that an item not
+                                    added tests as a member
+
+        """
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        ln2 = math.log(2)
+        self.n_bits = max(int(math.ceil(
+            -capacity * math.log(false_positive_rate) / (ln2 * ln2))), 8)
+        self.n_hashes = max(int(round(self.n_bits / capacity * ln2)), 1)
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, name: str) -> iter:
+        digest = hashlib.blake2b(str(name).encode('utf-8'),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return map(lambda i: (h1 + i * h2) % self.n_bits,
+                   range(self.n_hashes))
+
+    def add(self, name: str):
+        "Add ``name`` to the set."
+        for idx in self._indexes(name):
+            self.bits[idx >> 3] |= 1 << (idx & 7)
+        self.count += 1
+
+    def __contains__(self, name: str) -> bool:
+        return all(map(lambda idx: self.bits[idx >> 3] & (1 << (idx & 7)),
+                       self._indexes(name)))
+
+    def __str__(self):
+        return (f'bloom filter: bits={self.n_bits}, hashes={self.n_hashes}, ' +
+                f'count={self.count}/{self.capacity}')
+
+
+class BloomFilterStash(DelegateStash):
+    """Answers ``exists``, ``load`` and ``get`` for keys never dumped without
+    accessing the delegate by first testing a ``BloomFilter`` of the
+    delegate's keys.  This is useful in front of a ``DirectoryStash`` with
+    mostly negative lookups, such as the delegate of a ``FactoryStash``.
+
+    The filter is persisted to ``path`` on ``close`` and rebuilt from the
+    delegate's keys when it is missing.  The persisted filter is removed on
+    the first ``dump`` after it is read so a process that ends without
+    closing the stash does not leave a stale filter.  For delegates with a
+    ``create_path`` directory (i.e. ``DirectoryStash``), the directory's
+    modification time is saved with the filter, which is rebuilt when keys
+    were added to the directory by another stash.  This time is also checked
+    (with one ``stat``) before answering that a key is missing, so keys dumped
+    by other processes are found.
+
+    """
+    def __init__(self, delegate: Stash, path: Path = None,
+                 capacity: int = 100000, false_positive_rate: float = 0.01):
+        """Initialize.
+
+        :param delegate: the stash to filter
+        :param path: the file of the persisted filter, which defaults to the
+                     delegate's ``create_path`` with a ``.bloom`` extension
+                     when it has one, otherwise the filter is kept only in
+                     memory
+        :param capacity: the expected number of items, which grows to twice
+                         the number of keys when the filter is rebuilt
+        :param false_positive_rate: the desired rate of keys not in the
+                                    delegate that must be checked in it
+
+        """
+        super(BloomFilterStash, self).__init__(delegate)
+        if path is None and hasattr(delegate, 'create_path'):
+            cpath = delegate.create_path
+            path = cpath.parent / f'{cpath.name}.bloom'
+        self.path = path
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self._dirty = True
+        self._version = None
+
+    def _load_filter(self) -> BloomFilter:
+        """Return the persisted filter, or ``None`` if it is missing or the
+        delegate was modified since it was saved.
+
+        """
+        if self.path is not None and self.path.is_file():
+            logger.info(f'loading bloom filter from {self.path}')
+            with open(self.path, 'rb') as f:
+                version, bfilter = pickle.load(f)
+            if version == self._version:
+                return bfilter
+            logger.info(f'delegate modified since saving {self.path}')
+
+    @property
+    @persisted('_bloom_filter')
+    def bloom_filter(self) -> BloomFilter:
+        """Return the filter, which is read from ``path`` or rebuilt from the
+        delegate's keys.
+
+        """
+        self._version = _delegate_version(self.delegate)
+        bfilter = self._load_filter()
+        if bfilter is not None:
+            self._dirty = False
+        else:
+            with time('rebuilt bloom filter of {n_keys} keys'):
+                keys = tuple(self.delegate.keys())
+                n_keys = len(keys)
+                bfilter = BloomFilter(max(self.capacity, n_keys * 2),
+                                      self.false_positive_rate)
+                for k in keys:
+                    bfilter.add(k)
+        return bfilter
+
+    def save(self):
+        "Persist the filter to ``path``."
+        if self.path is not None and self._dirty:
+            logger.info(f'saving bloom filter to {self.path}')
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            bfilter = self.bloom_filter
+            with open(self.path, 'wb') as f:
+                pickle.dump((self._version, bfilter), f)
+            self._dirty = False
+
+    def _invalidate_persisted(self):
+        if not self._dirty:
+            self._dirty = True
+            if self.path is not None and self.path.is_file():
+                self.path.unlink()
+
+    def _contains(self, name: str) -> bool:
+        """Return whether key ``name`` might be in the delegate, rebuilding the
+        filter first when the delegate was modified by another stash.
+
+        """
+        if name in self.bloom_filter:
+            return True
+        version = _delegate_version(self.delegate)
+        if version is not None and version != self._version:
+            logger.info('delegate modified, so rebuilding bloom filter')
+            self._invalidate_persisted()
+            self._bloom_filter.clear()
+            return name in self.bloom_filter
+        return False
+
+    def load(self, name: str):
+        if self._contains(name):
+            return self.delegate.load(name)
+
+    def get(self, name: str, default=None):
+        if self._contains(name):
+            return self.delegate.get(name, default)
+        return default
+
+    def exists(self, name: str) -> bool:
+        return self._contains(name) and self.delegate.exists(name)
+
+    def dump(self, name: str, inst):
+        bfilter = self.bloom_filter
+        self._invalidate_persisted()
+        bfilter.add(name)
+        # only our own changes to the delegate keep the filter current
+        synced = self._version == _delegate_version(self.delegate)
+        ret = self.delegate.dump(name, inst)
+        if synced:
+            self._version = _delegate_version(self.delegate)
+        return ret
+
+    def clear(self):
+        self.delegate.clear()
+        self._invalidate_persisted()
+        if hasattr(self, '_bloom_filter'):
+            self._bloom_filter.clear()
+            self._version = _delegate_version(self.delegate)
+
+    def close(self):
+        self.save()
+        return super(BloomFilterStash, self).close()
+
+
 class DirectoryStash(Stash):
     """Creates a pickeled data file with a file name in a directory with a given
     pattern across all instances.
@@ -874,22 +2280,34 @@ class DirectoryStash(Stash):
 
     def keys(self):
         def path_to_key(path):
-            p = parse.parse(self.pattern, path.name).named
-            if 'name' in p:
-                return p['name']
+            p = parse.parse(self.pattern, path.name)
+            if p is not None and 'name' in p.named:
+                return p.named['name']
 
         if not self.create_path.is_dir():
             keys = ()
         else:
-            keys = filter(lambda x: x is not None,
-                          map(path_to_key, self.create_path.iterdir()))
+            # files being written by ``dump`` don't match the pattern
+            paths = self.create_path.iterdir()
+            keys = filter(lambda x: x is not None, map(path_to_key, paths))
         return keys
 
     def dump(self, name, inst):
+        """Write the instance to a temporary file that then replaces the instance's
+        file, so readers in other processes never see a partial file.
+
+        """
         logger.info(f'saving instance: {inst}')
         path = self._get_instance_path(name)
-        with open(path, 'wb') as f:
-            pickle.dump(inst, f)
+        tmp = path.parent / \
+            f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(inst, f)
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
 
     def delete(self, name):
         logger.info(f'deleting instance: {name}')
@@ -897,6 +2315,13 @@ class DirectoryStash(Stash):
         if path.exists():
             path.unlink()
 
+    def clear(self):
+        super(DirectoryStash, self).clear()
+        # remove temporary files left by writers killed during ``dump``
+        if self.create_path.is_dir():
+            for path in self.create_path.glob('.*.tmp'):
+                path.unlink()
+
     def close(self):
         pass
 
@@ -7,6 +7,11 @@ from zensols.actioncli import (
     FactoryStash,
     DictionaryStash,
     CacheStash,
+    ConcurrentStash,
+    ShardedStash,
+    InstrumentedStash,
+    TieredStash,
+    BloomFilterStash,
     DirectoryStash,
     ShelveStash,
 )
@@ -16,19 +21,40 @@ logger = logging.getLogger(__name__)
 
 class StashFactory(ConfigChildrenFactory):
     USE_CACHE_STASH_KEY = 'use_cache_stash'
+    USE_CONCURRENT_STASH_KEY = 'use_concurrent_stash'
     INSTANCE_CLASSES = {}
 
-    def __init__(self, config):
+    def __init__(self, config, instrument: bool = False):
+        """Initialize.
+
+        :param config: the configuration with the stash sections
+        :param instrument: if ``True`` wrap every stash created, including
+                           children, in an ``InstrumentedStash``
+
+        """
         super(StashFactory, self).__init__(config, '{name}_stash')
+        self.instrument = instrument
+
+    def instance(self, name=None, *args, **kwargs):
+        stash = super(StashFactory, self).instance(name, *args, **kwargs)
+        if self.instrument:
+            stash = InstrumentedStash(stash, name)
+        return stash
 
     def _instance(self, cls, *args, **kwargs):
         use_cache = False
+        use_concurrent = False
         if self.USE_CACHE_STASH_KEY in kwargs:
             use_cache = kwargs[self.USE_CACHE_STASH_KEY]
             del kwargs[self.USE_CACHE_STASH_KEY]
+        if self.USE_CONCURRENT_STASH_KEY in kwargs:
+            use_concurrent = kwargs[self.USE_CONCURRENT_STASH_KEY]
+            del kwargs[self.USE_CONCURRENT_STASH_KEY]
         stash = super(StashFactory, self)._instance(cls, *args, **kwargs)
         if use_cache:
             stash = CacheStash(stash)
+        if use_concurrent:
+            stash = ConcurrentStash(stash)
         return stash
 
 
@@ -38,6 +64,11 @@ for cls in (DelegateStash,
             FactoryStash,
             DictionaryStash,
             CacheStash,
+            ConcurrentStash,
+            ShardedStash,
+            InstrumentedStash,
+            TieredStash,
+            BloomFilterStash,
             DirectoryStash,
             ShelveStash):
     StashFactory.register(cls)
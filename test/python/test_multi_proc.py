@@ -1,9 +1,31 @@
 import logging
 import unittest
+import os
+import pickle
+import json
+import itertools as it
+import shutil
+from pathlib import Path
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import time
+import zensols.actioncli.multi as multi
 from zensols.actioncli import (
+    Config,
     DelegateStash,
+    DirectoryStash,
+    StashFactory,
     StashMapReducer,
     FunctionStashMapReducer,
+    StashCreator,
+    MultiProcessStash,
+    ChunkResult,
+    ChunkProgress,
+    AdaptiveChunker,
+    SerialPool,
+    imap_bounded,
 )
 
 logger = logging.getLogger(__name__)
@@ -21,6 +43,56 @@ class RangeStash(DelegateStash):
         return range(self.n)
 
 
+class MultiProcRangeStash(RangeStash):
+    pass
+
+
+StashFactory.register(MultiProcRangeStash)
+
+
+CREATE_LOG = Path('target/mpstash-created.log')
+FAIL_FLAG = Path('target/mpstash-fail')
+FAIL_ONCE_FLAG = Path('target/mpstash-fail-once')
+HANG_FLAG = Path('target/mpstash-hang')
+
+
+class RangeMultiProcessStash(MultiProcessStash):
+    def __init__(self, config, name, *args, n: int, delay: float = 0,
+                 **kwargs):
+        super(RangeMultiProcessStash, self).__init__(
+            config, name, *args, **kwargs)
+        self.n = n
+        self.delay = delay
+        with open(CREATE_LOG, 'a') as f:
+            f.write(f'{os.getpid()}\n')
+
+    def _create_data(self):
+        return range(self.n)
+
+    def _process(self, chunk):
+        if 7 in chunk:
+            if FAIL_FLAG.exists():
+                raise ValueError('chunk with 7')
+            if HANG_FLAG.exists():
+                time.sleep(30)
+            try:
+                FAIL_ONCE_FLAG.unlink()
+                raise ValueError('chunk with 7 once')
+            except FileNotFoundError:
+                pass
+        for i in chunk:
+            if self.delay > 0:
+                time.sleep(self.delay)
+            yield (str(i), i * 2)
+
+    def _key_data_index(self, name):
+        if name.isdigit():
+            return int(name)
+
+
+StashFactory.register(RangeMultiProcessStash)
+
+
 class IncMapReducer(StashMapReducer):
     def _map(self, id: str, val):
         return val + 1
@@ -34,6 +106,34 @@ class IncSumMapReducer(StashMapReducer):
         return sum(vals)
 
 
+class IncSumTotalMapReducer(IncSumMapReducer):
+    def _reduce_final(self, reduced_vals):
+        return sum(reduced_vals)
+
+
+class IncCombineMapReducer(IncMapReducer):
+    def _combine(self, vals):
+        return {'sum': sum(vals), 'count': len(vals)}
+
+    def _reduce_final(self, reduced_vals):
+        reduced_vals = tuple(reduced_vals)
+        return (sum(map(lambda x: x['sum'], reduced_vals)),
+                sum(map(lambda x: x['count'], reduced_vals)))
+
+
+class BatchRangeStash(RangeStash):
+    def load_batch(self, names):
+        return list(map(lambda x: x * 10, names))
+
+
+class IncBatchMapReducer(StashMapReducer):
+    def _map_batch(self, ids, vals):
+        return [ids, tuple(map(lambda x: x + 1, vals))]
+
+    def _reduce(self, vals):
+        return sum(vals[1])
+
+
 def inc2(id, val):
     return val + 2
 
@@ -61,3 +161,445 @@ class TestMultiProc(unittest.TestCase):
         stash = RangeStash(10)
         dat = FunctionStashMapReducer.map_func(stash, func=inc2, n_workers=2)
         self.assertEqual(((2, 3, 4, 5, 6), (7, 8, 9, 10, 11)), tuple(dat))
+
+    def test_stash_creator(self):
+        creator = StashCreator(
+            Config('test-resources/stash-factory.conf'), 'mprange')
+        mp = IncSumMapReducer(n_workers=2, stash_creator=creator)
+        self.assertTrue(isinstance(mp.stash, MultiProcRangeStash))
+        self.assertEqual((15, 40), tuple(mp()))
+        mp2 = pickle.loads(pickle.dumps(mp))
+        self.assertEqual(None, mp2.stash)
+        mp2._init_worker()
+        self.assertTrue(isinstance(mp2.stash, MultiProcRangeStash))
+
+    def test_streaming(self):
+        mp = IncSumTotalMapReducer(RangeStash(100), 4, streaming=True)
+        self.assertEqual(sum(range(1, 101)), mp())
+        mp = IncSumTotalMapReducer(RangeStash(100), 3, streaming=True,
+                                   fan_in=2)
+        self.assertEqual(sum(range(1, 101)), mp())
+        mp = IncSumTotalMapReducer(RangeStash(0), 3, streaming=True)
+        self.assertEqual(0, mp())
+
+    def test_pool_lifecycle(self):
+        with IncSumMapReducer(RangeStash(10), 2, maxtasksperchild=1) as mp:
+            pool = mp._pool
+            self.assertTrue(pool is not None)
+            self.assertEqual((15, 40), tuple(mp()))
+            self.assertEqual((15, 40), tuple(mp()))
+            self.assertTrue(pool is mp._pool)
+        self.assertEqual(None, mp._pool)
+        self.assertEqual((15, 40), tuple(mp()))
+        self.assertEqual(None, mp._pool)
+
+    def test_shared_pool(self):
+        with Pool(2) as pool:
+            mp = IncSumMapReducer(RangeStash(10), 2, pool=pool)
+            self.assertEqual((15, 40), tuple(mp()))
+            mp = IncMapReducer(RangeStash(4), 2, pool=pool)
+            self.assertEqual(((1, 2), (3, 4)), tuple(mp()))
+            mp = IncSumTotalMapReducer(RangeStash(100), 2, pool=pool,
+                                       streaming=True)
+            self.assertEqual(sum(range(1, 101)), mp())
+
+    def test_combine(self):
+        mp = IncCombineMapReducer(RangeStash(10), 2)
+        self.assertEqual(({'sum': 15, 'count': 5}, {'sum': 40, 'count': 5}),
+                         tuple(mp.map()))
+        self.assertEqual((55, 10), mp())
+
+    def test_map_batch(self):
+        mp = IncBatchMapReducer(BatchRangeStash(4), 2)
+        self.assertEqual([[(0, 1), (1, 11)], [(2, 3), (21, 31)]], mp.map())
+        self.assertEqual((12, 52), tuple(mp()))
+
+    def test_result_stash(self):
+        path = Path('target/mr-result')
+        if path.exists():
+            shutil.rmtree(path)
+        res_stash = DirectoryStash(path)
+        mp = IncMapReducer(RangeStash(10), 2, result_stash=res_stash)
+        self.assertTrue(mp() is res_stash)
+        self.assertEqual(set(map(lambda x: (str(x), x + 1), range(10))),
+                         set(res_stash))
+        shutil.rmtree(path)
+        res = FunctionStashMapReducer.map_func(
+            RangeStash(4), func=inc2, n_workers=2, result_stash=res_stash)
+        self.assertEqual({'0': 2, '1': 3, '2': 4, '3': 5}, dict(res))
+        shutil.rmtree(path)
+        mp = IncBatchMapReducer(BatchRangeStash(4), 2, result_stash=res_stash)
+        mp()
+        self.assertEqual({'0': [(0, 1), (1, 11)], '2': [(2, 3), (21, 31)]},
+                         dict(res_stash))
+
+    def test_adaptive_chunker(self):
+        chunker = AdaptiveChunker(1., n_workers=2, max_size=50)
+        self.assertEqual(1, chunker.next_size())
+        chunker.observe(1, 0.1)
+        # growth is limited from the last size
+        self.assertEqual(4, chunker.next_size())
+        self.assertEqual(10, chunker.next_size())
+        # balance the remaining items across workers
+        self.assertEqual(3, chunker.next_size(5))
+        # cheaper items make larger chunks up to the target duration
+        chunker.observe(10, 0.01)
+        self.assertEqual(12, chunker.next_size())
+        self.assertEqual(19, chunker.next_size())
+        chunker.observe(19, 0)
+        self.assertEqual(39, chunker.next_size())
+        chunker.observe(39, 0)
+        self.assertEqual(50, chunker.next_size())
+        chunker = AdaptiveChunker(1., n_workers=2)
+        self.assertEqual([[0], [1, 2, 3, 4], [5, 6, 7], [8], [9]],
+                         list(map(list, chunker.chunks(
+                             _observed(chunker, range(10)), 10))))
+
+    def test_adaptive_map(self):
+        mp = IncSumMapReducer(RangeStash(100), 3, chunk_duration=0.1,
+                              max_group_size=20)
+        vals = mp.map()
+        self.assertEqual(list(range(1, 101)), list(it.chain(*vals)))
+        self.assertTrue(len(vals) > 3)
+        self.assertTrue(all(map(lambda v: len(v) <= 20, vals)))
+        self.assertEqual(sum(range(1, 101)), sum(mp()))
+        mp = IncSumTotalMapReducer(RangeStash(100), 3, streaming=True,
+                                   chunk_duration=0.1)
+        self.assertEqual(sum(range(1, 101)), mp())
+
+    def test_backends(self):
+        for backend in 'thread serial'.split():
+            mp = IncSumMapReducer(RangeStash(10), 2, backend=backend)
+            self.assertEqual((15, 40), tuple(mp()))
+            mp = IncSumTotalMapReducer(RangeStash(100), 3, streaming=True,
+                                       backend=backend)
+            self.assertEqual(sum(range(1, 101)), mp())
+        for executor in (ThreadPoolExecutor(2), ProcessPoolExecutor(2)):
+            with executor:
+                mp = IncSumMapReducer(RangeStash(10), 2, executor=executor)
+                self.assertEqual((15, 40), tuple(mp()))
+                mp = IncSumTotalMapReducer(RangeStash(100), 2,
+                                           streaming=True, executor=executor)
+                self.assertEqual(sum(range(1, 101)), mp())
+        with self.assertRaisesRegex(ValueError, r'unknown pool backend'):
+            IncSumMapReducer(RangeStash(10), 2, backend='nada')()
+
+    def test_in_process_contexts(self):
+        mps = []
+        for backend in ('thread', 'serial') * 5:
+            mp = IncSumMapReducer(RangeStash(10), 2, backend=backend)
+            mp.__enter__()
+            mps.append(mp)
+        for mp in mps:
+            self.assertEqual((15, 40), tuple(mp()))
+        for mp in mps:
+            mp.__exit__(None, None, None)
+            self.assertFalse(mp._token in multi._WORKER_REDUCERS)
+
+    def test_serial_pool(self):
+        pool = SerialPool()
+        res = pool.apply_async(inc2, (None, 1))
+        self.assertTrue(res.ready())
+        self.assertEqual(3, res.get())
+        self.assertEqual([2, 3], list(imap_bounded(
+            pool, lambda x: x + 1, range(1, 3), 1)))
+        res = pool.apply_async(inc2, (None, None))
+        self.assertFalse(res.successful())
+        with self.assertRaises(TypeError):
+            res.get()
+
+
+def _observed(chunker, items):
+    "Observe each item as instant so sizes only grow."
+    for i in items:
+        chunker.observe(1, 0)
+        yield i
+
+
+class TestMultiProcessStash(unittest.TestCase):
+    def setUp(self):
+        self.conf = Config('test-resources/stash-factory.conf')
+        self.path = Path('target/mpstash')
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.manifest_path = Path('target/mpstash.manifest')
+        for path in (CREATE_LOG, FAIL_FLAG, FAIL_ONCE_FLAG, HANG_FLAG,
+                     self.manifest_path):
+            if path.exists():
+                path.unlink()
+        CREATE_LOG.parent.mkdir(exist_ok=True)
+
+    def _n_files(self, path: Path) -> int:
+        # killed workers leave the temporary files of unfinished dumps
+        return len(tuple(filter(lambda p: p.suffix != '.tmp',
+                                path.iterdir())))
+
+    def tearDown(self):
+        for path in (FAIL_FLAG, FAIL_ONCE_FLAG, HANG_FLAG):
+            if path.exists():
+                path.unlink()
+
+    def test_prime(self):
+        stash = StashFactory(self.conf).instance('mpstash')
+        self.assertEqual(4, stash.max_pending)
+        self.assertEqual(set(map(str, range(20))), set(stash.keys()))
+        self.assertEqual(14, stash.load('7'))
+        self.assertEqual(20, self._n_files(self.path))
+        with open(CREATE_LOG) as f:
+            # once in the parent and once in each worker
+            self.assertEqual(3, len(f.readlines()))
+        self.assertTrue(stash.manifest.complete)
+        self.assertEqual(set(range(7)), stash.manifest.done_chunks)
+
+    def test_stale_manifest(self):
+        stash = StashFactory(self.conf).instance('mpstash')
+        stash.prime()
+        self.assertTrue(stash.manifest.complete)
+        shutil.rmtree(self.path)
+        stash = StashFactory(self.conf).instance('mpstash')
+        self.assertFalse(stash.has_data)
+        self.assertFalse(stash.manifest.exists)
+        self.assertEqual(14, stash.load('7'))
+        self.assertEqual(20, self._n_files(self.path))
+        self.assertTrue(stash.manifest.complete)
+
+    def test_resume(self):
+        FAIL_FLAG.touch()
+        stash = StashFactory(self.conf).instance('mpstash')
+        # the error of the chunk stops priming
+        with self.assertRaisesRegex(ValueError, r'^chunk with 7$'):
+            stash.prime()
+        self.assertFalse(stash.manifest.complete)
+        self.assertFalse(2 in stash.manifest.done_chunks)
+        FAIL_FLAG.unlink()
+        stash = StashFactory(self.conf).instance('mpstash')
+        self.assertFalse(stash.has_data)
+        self.assertEqual(14, stash.load('7'))
+        self.assertEqual(20, self._n_files(self.path))
+        self.assertTrue(stash.manifest.complete)
+        chunks = tuple(filter(lambda x: x['status'] == 'done',
+                              self._chunk_entries()))
+        # only the items not yet done are processed again
+        self.assertEqual(20, sum(map(lambda x: x['size'], chunks)))
+        self.assertEqual([(0, 20)], stash.manifest.done_spans)
+        stash.clear()
+        self.assertFalse(self.manifest_path.exists())
+        self.assertEqual(0, self._n_files(self.path))
+
+    def test_clear_failed(self):
+        FAIL_FLAG.touch()
+        stash = StashFactory(self.conf).instance('mpstash')
+        with self.assertRaisesRegex(ValueError, r'^chunk with 7$'):
+            stash.prime()
+        self.assertTrue(self._n_files(self.path) > 0)
+        # clearing doesn't prime the rest of the data
+        stash.clear()
+        self.assertFalse(self.manifest_path.exists())
+        self.assertEqual(0, self._n_files(self.path))
+
+    def test_failed_retries(self):
+        FAIL_FLAG.touch()
+        stash = StashFactory(self.conf).instance('mpstash')
+        stash.max_retries = 1
+        stash.retry_backoff = 0.01
+        with self.assertRaisesRegex(ValueError, r'1 chunk\(s\) failed'):
+            stash.prime()
+        self.assertFalse(stash.manifest.complete)
+        self.assertEqual(set(range(7)) - {2}, stash.manifest.done_chunks)
+        self.assertEqual([(0, 6), (9, 20)], stash.manifest.done_spans)
+
+    def test_progress(self):
+        stash = StashFactory(self.conf).instance('mpstash')
+        self.assertEqual('log', stash.progress)
+        stash.progress = 'json'
+        stash.progress_path = Path('target/mpstash.progress.json')
+        stash.prime()
+        with open(stash.progress_path) as f:
+            prog = json.load(f)
+        self.assertTrue(prog['complete'])
+        self.assertEqual(7, prog['chunks'])
+        self.assertEqual(7, prog['n_chunks'])
+        self.assertEqual(20, prog['items'])
+        self.assertEqual(0, prog['eta'])
+        self.assertTrue(1 <= len(prog['workers']) <= 2)
+        self.assertEqual(5, len(prog['slowest_chunks']))
+        self.assertEqual(20, stash.last_progress.items)
+
+    def test_adaptive(self):
+        stash = StashFactory(self.conf).instance('mpstash')
+        stash.chunk_duration = 0.5
+        self.assertEqual(set(map(str, range(20))), set(stash.keys()))
+        self.assertEqual(14, stash.load('7'))
+        with open(self.manifest_path) as f:
+            chunks = tuple(filter(lambda x: 'chunk' in x,
+                                  map(json.loads, f.readlines())))
+        # starts with probes no larger than the maximum chunk size
+        self.assertEqual(1, chunks[0]['size'])
+        self.assertTrue(all(map(lambda c: c['size'] <= 3, chunks)))
+        self.assertEqual([(0, 20)], stash.manifest.done_spans)
+
+    def test_chunk_progress(self):
+        prog = ChunkProgress(4)
+        self.assertEqual(None, prog.eta)
+        prog.update(ChunkResult(0, 10, None, 1, 0, 2))
+        prog.update(ChunkResult(1, 10, None, 2, 0, 3))
+        prog.update(ChunkResult(2, None, 'err', 1, 2, 2.5))
+        self.assertEqual(20, prog.items)
+        self.assertEqual(1, prog.failed)
+        self.assertEqual({1: 2.5, 2: 3}, prog.busy)
+        self.assertEqual([1, 0, 2], list(prog.slowest_chunks.keys()))
+        self.assertAlmostEqual(prog.elapsed / 3, prog.eta, 2)
+        prog.finish()
+        self.assertTrue(str(prog).startswith('chunks: 3/4, items: 20'))
+
+    def test_backend(self):
+        path = Path('target/mpstash-thread')
+        stash = StashFactory(self.conf).instance('mpstash_thread')
+        stash.clear()
+        self.assertEqual('thread', stash.backend)
+        self.assertEqual(14, stash.load('7'))
+        self.assertEqual(20, self._n_files(path))
+        with open(CREATE_LOG) as f:
+            # workers use the parent's stash
+            self.assertEqual(1, len(f.readlines()))
+        stash.clear()
+        stash.backend = 'serial'
+        self.assertEqual(set(map(str, range(20))), set(stash.keys()))
+        stash.clear()
+        with ProcessPoolExecutor(2) as executor:
+            stash.executor = executor
+            self.assertEqual(14, stash.load('7'))
+        self.assertEqual(20, self._n_files(path))
+        shutil.rmtree(path)
+
+    def test_background(self):
+        stash = StashFactory(self.conf).instance('mpstash_bg')
+        stash.clear()
+        self.assertTrue(stash.background)
+        # the last items are created first when asked for
+        self.assertEqual(380, stash.load('190'))
+        self.assertTrue(stash.priming)
+        self.assertEqual(2, stash.get('1'))
+        # waits for priming to finish
+        self.assertEqual(None, stash.get('nada'))
+        self.assertFalse(stash.priming)
+        self.assertTrue(stash.has_data)
+        self.assertEqual(set(map(str, range(200))), set(stash.keys()))
+        with open('target/mpstash-bg.manifest') as f:
+            chunks = tuple(filter(lambda x: 'chunk' in x,
+                                  map(json.loads, f.readlines())))
+        self.assertTrue({'offset': 190, 'size': 1} in
+                        map(lambda c: {'offset': c['offset'],
+                                       'size': c['size']}, chunks))
+        self.assertEqual(200, sum(map(lambda c: c['size'], chunks)))
+        stash.clear()
+
+    def _chunk_entries(self):
+        with open(self.manifest_path) as f:
+            return tuple(filter(lambda x: 'chunk' in x,
+                                map(json.loads, f.readlines())))
+
+    def _n_created(self):
+        with open(CREATE_LOG) as f:
+            return len(f.readlines())
+
+    def test_retry(self):
+        FAIL_ONCE_FLAG.touch()
+        stash = StashFactory(self.conf).instance('mpstash')
+        stash.max_retries = 1
+        stash.retry_backoff = 0.01
+        with self.assertLogs('zensols.actioncli.multi', 'WARNING') as cm:
+            self.assertEqual(14, stash.load('7'))
+        self.assertTrue(any(map(lambda m: 'retrying chunk 2' in m,
+                                cm.output)))
+        self.assertTrue(stash.manifest.complete)
+        self.assertEqual([(0, 20)], stash.manifest.done_spans)
+
+    def test_quarantine(self):
+        FAIL_FLAG.touch()
+        stash = StashFactory(self.conf).instance('mpstash')
+        stash.max_retries = 1
+        stash.retry_backoff = 0.01
+        stash.quarantine = True
+        self.assertEqual(None, stash.load('7'))
+        self.assertEqual(18, stash.load('9'))
+        self.assertEqual([2], list(map(lambda r: r.chunk_id,
+                                       stash.quarantined)))
+        self.assertTrue(stash.manifest.complete)
+        self.assertEqual(1, len(stash.manifest.quarantined))
+        self.assertEqual(17, self._n_files(self.path))
+
+    def test_timeout(self):
+        HANG_FLAG.touch()
+        # other chunks are still pending when the hung chunk times out
+        stash = StashFactory(self.conf).instance('mpstash_slow')
+        stash.chunk_timeout = 0.5
+        stash.quarantine = True
+        self.assertEqual(18, stash.load('9'))
+        self.assertEqual(None, stash.load('7'))
+        self.assertEqual(1, len(stash.quarantined))
+        self.assertTrue(stash.quarantined[0].error.startswith(
+            'TimeoutError'))
+        self.assertEqual(17, self._n_files(self.path))
+        # the workers were replaced after the timeout
+        self.assertTrue(self._n_created() > 3)
+        stash.clear()
+        stash.backend = 'thread'
+        with self.assertRaisesRegex(ValueError, r'need the process backend'):
+            stash.prime()
+        with self.assertRaisesRegex(ValueError, r'need the process backend'):
+            RangeMultiProcessStash(
+                self.conf, 'mpstash', stash.delegate, 3, 2, n=20,
+                backend='serial', chunk_timeout=1)
+
+    def test_exports(self):
+        import zensols.actioncli as pkg
+        import zensols.actioncli.persist as persist
+        # module imports of ``multi`` don't replace earlier exports
+        self.assertIs(persist.resource, pkg.resource)
+
+    def test_recycle(self):
+        stash = StashFactory(self.conf).instance('mpstash')
+        stash.max_worker_rss = 1
+        self.assertEqual(14, stash.load('7'))
+        self.assertEqual(20, self._n_files(self.path))
+        self.assertTrue(self._n_created() > 3)
+        stash.clear()
+        os.unlink(CREATE_LOG)
+        stash.max_worker_rss = None
+        stash.maxtasksperchild = 1
+        self.assertEqual(14, stash.load('7'))
+        # a new worker for each chunk
+        self.assertTrue(self._n_created() >= 7)
+
+    def test_pickle(self):
+        stash = StashFactory(self.conf).instance('mpstash_bg')
+        stash2 = pickle.loads(pickle.dumps(stash))
+        self.assertTrue(stash2.background)
+        self.assertFalse(stash2.priming)
+        self.assertEqual(stash.manifest.path, stash2.manifest.path)
+        stash = StashFactory(self.conf).instance('mpstash')
+        with Pool(2) as pool:
+            mp = IncSumTotalMapReducer(stash, 2, pool=pool)
+            self.assertEqual(sum(map(lambda i: (i * 2) + 1, range(20))), mp())
+
+    def test_imap_bounded(self):
+        lock = threading.Lock()
+        stats = {'taken': 0, 'done': 0, 'max': 0}
+
+        def data():
+            for i in range(50):
+                with lock:
+                    stats['taken'] += 1
+                    ahead = stats['taken'] - stats['done']
+                    stats['max'] = max(stats['max'], ahead)
+                yield i
+
+        with ThreadPool(3) as pool:
+            res = []
+            for r in imap_bounded(pool, lambda x: x * 2, data(), 4):
+                with lock:
+                    stats['done'] += 1
+                res.append(r)
+        self.assertEqual(set(map(lambda x: x * 2, range(50))), set(res))
+        self.assertTrue(stats['max'] <= 5)
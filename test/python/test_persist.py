@@ -2,7 +2,12 @@ import logging
 from sys import platform
 from pathlib import Path
 import pickle
+import json
 from io import BytesIO
+import threading
+import shutil
+from multiprocessing import Pool
+import time as tm
 import unittest
 from zensols.actioncli import (
     persisted,
@@ -12,9 +17,17 @@ from zensols.actioncli import (
     ShelveStash,
     shelve,
     FactoryStash,
+    OneShotFactoryStash,
+    OrderedKeyStash,
     DelegateStash,
     DictionaryStash,
     CacheStash,
+    ConcurrentStash,
+    ShardedStash,
+    TieredStash,
+    BloomFilter,
+    BloomFilterStash,
+    prefetch,
 )
 
 #logging.basicConfig(level=logging.DEBUG)
@@ -429,3 +442,530 @@ class TestStash(unittest.TestCase):
         self.assertEqual(((0, 0), (1, 1), (2, 2), (3, 3), (4, 4)),
                          tuple(sorted(stash.cache_stash, key=lambda x: x[0])))
 
+
+
+class SlowIncStash(IncStash):
+    def load(self, name: str):
+        tm.sleep(0.05)
+        return super(SlowIncStash, self).load(name)
+
+
+class TestConcurrentStash(unittest.TestCase):
+    def _run_threads(self, fn, n=8):
+        threads = tuple(map(lambda x: threading.Thread(target=fn),
+                            range(n)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_single_flight(self):
+        ins = SlowIncStash()
+        stash = ConcurrentStash(FactoryStash(DictionaryStash(), ins))
+        res = []
+        self._run_threads(lambda: res.append(stash['a']))
+        self.assertEqual(1, ins.c)
+        self.assertEqual(['a-1'] * 8, res)
+        self.assertEqual(('a',), stash.keys())
+        stash.clear()
+        self.assertEqual((), stash.keys())
+
+    def test_stripes(self):
+        stash = ConcurrentStash(DictionaryStash(), n_stripes=4)
+        self._run_threads(lambda: [stash.dump(i, i) for i in range(100)])
+        self.assertEqual(100, len(stash))
+        self.assertEqual(5, stash.load(5))
+        stash2 = pickle.loads(pickle.dumps(stash))
+        self.assertEqual(5, stash2.load(5))
+        self.assertEqual(4, len(stash2._locks))
+
+
+class SlowRangeStash(RangeStash):
+    def load(self, name: str):
+        tm.sleep(0.01 * (name % 3))
+        return name * 2
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_ordered(self):
+        stash = SlowRangeStash(20)
+        should = tuple(map(lambda x: (x, x * 2), range(20)))
+        self.assertEqual(should, tuple(stash.items(n_workers=4)))
+        self.assertEqual(should, tuple(stash.items()))
+        self.assertEqual(tuple(map(lambda x: x * 2, range(20))),
+                         tuple(stash.values(n_workers=3, max_pending=1)))
+
+    def test_unordered(self):
+        stash = SlowRangeStash(20)
+        should = set(map(lambda x: (x, x * 2), range(20)))
+        items = tuple(stash.items(n_workers=4, ordered=False))
+        self.assertEqual(20, len(items))
+        self.assertEqual(should, set(items))
+        self.assertEqual(((5, 10), (6, 12)),
+                         tuple(prefetch(stash, (5, 6), n_workers=2)))
+
+
+class TestShardedStash(unittest.TestCase):
+    def test_routing(self):
+        shards = tuple(DictionaryStash() for _ in range(3))
+        stash = ShardedStash(shards)
+        for i in range(30):
+            stash.dump(str(i), i)
+        self.assertEqual(30, len(stash))
+        self.assertEqual(set(map(str, range(30))), set(stash.keys()))
+        self.assertEqual(30, sum(map(len, shards)))
+        self.assertTrue(all(map(lambda s: len(s) > 0, shards)))
+        self.assertEqual(7, stash.load('7'))
+        self.assertTrue(stash.exists('7'))
+        idx = ShardedStash.shard_index('7', 3)
+        self.assertEqual(7, shards[idx].load('7'))
+        self.assertEqual([3, 1, 20], stash.load_batch(['3', '1', '20']))
+        stash.delete('7')
+        self.assertFalse(stash.exists('7'))
+        stash.clear()
+        self.assertEqual(0, len(stash))
+
+    def test_reshard(self):
+        shards = [DictionaryStash(), DictionaryStash()]
+        stash = ShardedStash(shards)
+        stash.dump_batch(map(lambda i: (str(i), i), range(40)))
+        self.assertEqual(40, len(stash))
+        stash = stash.reshard(shards + [DictionaryStash()])
+        self.assertEqual(3, len(stash.delegates))
+        self.assertEqual(40, len(stash))
+        for i in range(40):
+            self.assertEqual(i, stash.delegates[
+                ShardedStash.shard_index(str(i), 3)].load(str(i)))
+
+    def test_reshard_directories(self):
+        path = Path('target/reshard-test')
+        if path.exists():
+            shutil.rmtree(path)
+
+        def shards(n):
+            return [DirectoryStash(path / f'd{i}') for i in range(n)]
+
+        stash = ShardedStash(shards(2))
+        stash.dump_batch(map(lambda i: (str(i), i), range(20)))
+        # new instances on the same directories keep their items in place
+        stash = stash.reshard(shards(3))
+        self.assertEqual(20, len(stash))
+        for i in range(20):
+            self.assertEqual(i, stash.load(str(i)))
+
+
+class TestTieredStash(unittest.TestCase):
+    def test_promote_demote(self):
+        mem, ssd, hdd = DictionaryStash(), DictionaryStash(), DictionaryStash()
+        stash = TieredStash((mem, ssd, hdd), (2, 3, None))
+        for i in range(6):
+            stash.dump(i, i * 10)
+        self.assertEqual({4, 5}, set(mem.keys()))
+        self.assertEqual({1, 2, 3}, set(ssd.keys()))
+        self.assertEqual(set(range(6)), set(hdd.keys()))
+        self.assertEqual(set(range(6)), set(stash.keys()))
+        self.assertEqual(50, stash.load(5))
+        self.assertEqual(10, stash.load(1))
+        self.assertEqual({5, 1}, set(mem.keys()))
+        self.assertEqual(0, stash.load(0))
+        self.assertEqual({1, 0}, set(mem.keys()))
+        self.assertTrue(5 in ssd.keys())
+        self.assertEqual((1 / 3, 1 / 3, 1 / 3), stash.hit_rates)
+        self.assertEqual(None, stash.load(10))
+        stash.delete(1)
+        self.assertFalse(stash.exists(1))
+        self.assertTrue(stash.exists(2))
+        stash.clear()
+        self.assertEqual((), stash.keys())
+
+    def test_update(self):
+        mem, hdd = DictionaryStash(), DictionaryStash()
+        stash = TieredStash((mem, hdd), (1, None), write_through=False)
+        stash.dump('a', 1)
+        stash.dump('b', 2)
+        self.assertEqual({'b'}, set(mem.keys()))
+        self.assertEqual({'a'}, set(hdd.keys()))
+        stash.dump('a', 3)
+        self.assertEqual(3, stash.load('a'))
+        self.assertEqual(2, hdd.load('b'))
+        self.assertEqual(3, stash.load('a'))
+
+    def test_delete_all(self):
+        mem, hdd = DictionaryStash(), DictionaryStash()
+        stash = TieredStash((mem, hdd), (2, None))
+        for i in range(3):
+            stash.dump(i, i)
+        stash.delete()
+        self.assertEqual((), stash.keys())
+        self.assertEqual(0, len(stash._lru[0]))
+        self.assertEqual(None, stash.load(2))
+        stash.dump(2, 20)
+        self.assertEqual(20, stash.load(2))
+
+
+class CountExistsStash(DictionaryStash):
+    def __init__(self):
+        super(CountExistsStash, self).__init__()
+        self.n_exists = 0
+
+    def exists(self, name: str):
+        self.n_exists += 1
+        return super(CountExistsStash, self).exists(name)
+
+
+class TestBloomFilterStash(unittest.TestCase):
+    def setUp(self):
+        self.path = Path('target/bloom-test')
+        if self.path.exists():
+            shutil.rmtree(self.path)
+
+    def test_filter(self):
+        bf = BloomFilter(100, 0.01)
+        for i in range(100):
+            bf.add(f'k{i}')
+        self.assertTrue(all(map(lambda i: f'k{i}' in bf, range(100))))
+        fps = sum(map(lambda i: f'n{i}' in bf, range(1000)))
+        self.assertTrue(fps < 50)
+
+    def test_negative_lookup(self):
+        delegate = CountExistsStash()
+        stash = BloomFilterStash(delegate)
+        stash.dump('a', 1)
+        self.assertTrue(stash.exists('a'))
+        self.assertEqual(1, delegate.n_exists)
+        for i in range(50):
+            self.assertFalse(stash.exists(f'n{i}'))
+            self.assertEqual(None, stash.load(f'n{i}'))
+        self.assertTrue(delegate.n_exists < 5)
+
+    def test_persist(self):
+        dstash = DirectoryStash(self.path / 'data')
+        dstash.dump('a', 1)
+        stash = BloomFilterStash(dstash, false_positive_rate=0.001)
+        bloom_path = self.path / 'data.bloom'
+        self.assertEqual(bloom_path, stash.path)
+        self.assertEqual(1, stash.load('a'))
+        stash.dump('b', 2)
+        self.assertFalse(bloom_path.exists())
+        stash.close()
+        self.assertTrue(bloom_path.exists())
+        stash = BloomFilterStash(dstash)
+        self.assertTrue(stash.exists('b'))
+        self.assertFalse(stash._dirty)
+        stash.dump('c', 3)
+        self.assertFalse(bloom_path.exists())
+        stash = BloomFilterStash(dstash)
+        self.assertEqual(3, stash.load('c'))
+        self.assertEqual(3, stash.bloom_filter.count)
+
+    def test_stale_persist(self):
+        dstash = DirectoryStash(self.path / 'data')
+        dstash.dump('a', 1)
+        stash = BloomFilterStash(dstash)
+        stash.dump('b', 2)
+        stash.close()
+        stash = BloomFilterStash(dstash)
+        self.assertTrue(stash.exists('b'))
+        self.assertFalse(stash._dirty)
+        tm.sleep(0.01)
+        dstash.dump('c', 3)
+        stash = BloomFilterStash(dstash)
+        self.assertTrue(stash.exists('c'))
+        self.assertEqual(3, stash.load('c'))
+        self.assertTrue(stash._dirty)
+        stash.close()
+        stash = BloomFilterStash(dstash)
+        self.assertTrue(stash.exists('c'))
+        self.assertFalse(stash._dirty)
+
+    def test_shared_delegate(self):
+        dstash = DirectoryStash(self.path / 'data')
+        dstash.dump('a', 1)
+        stash = BloomFilterStash(dstash)
+        self.assertFalse(stash.exists('b'))
+        tm.sleep(0.01)
+        # as dumped by another process to the same directory
+        DirectoryStash(self.path / 'data').dump('b', 2)
+        self.assertTrue(stash.exists('b'))
+        self.assertEqual(2, stash.load('b'))
+        self.assertFalse(stash.exists('c'))
+        stash.dump('c', 3)
+        self.assertEqual(3, stash.get('c'))
+
+
+class BarrierIncStash(IncStash):
+    "Loads wait on ``barrier`` when it is set."
+    def __init__(self):
+        super(BarrierIncStash, self).__init__()
+        self.barrier = None
+
+    def load(self, name: str):
+        if self.barrier is not None:
+            self.barrier.wait()
+        return super(BarrierIncStash, self).load(name)
+
+
+class TestFactoryStashBatch(unittest.TestCase):
+    def test_load_batch(self):
+        ins = BarrierIncStash()
+        ds = DictionaryStash()
+        st = FactoryStash(ds, ins, n_workers=4)
+        st['a']
+        self.assertTrue(st.has_data)
+        # the four missing items are created concurrently
+        ins.barrier = threading.Barrier(4, timeout=5)
+        items = st.load_batch(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual('a-1', items[0])
+        self.assertEqual(5, ins.c)
+        self.assertEqual(set('abcde'), set(ds.keys()))
+        self.assertEqual(items, st.load_batch('abcde'))
+        self.assertEqual(5, ins.c)
+
+    def test_create_batch(self):
+        ds = DictionaryStash()
+        st = FactoryStash(ds, RangeStash(10), n_workers=2)
+        self.assertFalse(st.has_data)
+        self.assertEqual(10, st.create_batch())
+        self.assertTrue(st.has_data)
+        self.assertEqual(set(range(10)), set(ds.keys()))
+        self.assertEqual(0, st.create_batch())
+
+
+class GatedDumpStash(DictionaryStash):
+    "Dumps wait until ``gate``, when given, is set."
+    def __init__(self):
+        super(GatedDumpStash, self).__init__()
+        self.gate = threading.Event()
+
+    def dump(self, name: str, inst):
+        if self.gate is not None:
+            self.gate.wait(timeout=5)
+        super(GatedDumpStash, self).dump(name, inst)
+
+
+class TestFactoryStashAsync(unittest.TestCase):
+    def test_async_dump(self):
+        ins = IncStash()
+        ds = GatedDumpStash()
+        st = FactoryStash(ds, ins, async_dump=True, dump_queue_size=2)
+        self.assertEqual('a-1', st['a'])
+        self.assertEqual('b-2', st['b'])
+        # items are returned before they are written
+        self.assertEqual((), tuple(ds.keys()))
+        self.assertTrue(st.exists('a'))
+        self.assertEqual('b-2', st.load('b'))
+        self.assertEqual({'a', 'b'}, set(st.keys()))
+        ds.gate.set()
+        st.flush()
+        ds.gate = None
+        self.assertEqual({'a', 'b'}, set(ds.keys()))
+        self.assertEqual('a-1', st['a'])
+        self.assertEqual(2, ins.c)
+        st2 = pickle.loads(pickle.dumps(st))
+        self.assertEqual('b-2', st2['b'])
+        st.close()
+        self.assertEqual(None, st._writer)
+
+
+class SlowCreateStash(DelegateStash):
+    def __init__(self, log_path: Path):
+        super(SlowCreateStash, self).__init__()
+        self.log_path = log_path
+
+    def load(self, name: str):
+        tm.sleep(0.2)
+        with open(self.log_path, 'a') as f:
+            f.write(f'{name}\n')
+        return f'{name}-created'
+
+
+def load_locked_item(stash):
+    return stash['a']
+
+
+class TestFactoryStashLock(unittest.TestCase):
+    def setUp(self):
+        self.path = Path('target/lock-test')
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+
+    def test_cross_process(self):
+        log_path = self.path / 'created.log'
+        stash = FactoryStash(DirectoryStash(self.path / 'data'),
+                             SlowCreateStash(log_path),
+                             lock_path=self.path / 'locks')
+        with Pool(4) as pool:
+            items = pool.map(load_locked_item, (stash,) * 4)
+        self.assertEqual(['a-created'] * 4, items)
+        with open(log_path) as f:
+            self.assertEqual(['a'], f.read().split())
+        self.assertEqual(['a'], list(stash.delegate.keys()))
+        # lock files are removed once the item is persisted
+        self.assertEqual([], list((self.path / 'locks').iterdir()))
+        self.assertEqual(['a.dat'], list(map(
+            lambda p: p.name, (self.path / 'data').iterdir())))
+
+    def test_atomic_dump(self):
+        stash = DirectoryStash(self.path / 'data')
+        stash.dump('a', 1)
+        (self.path / 'data' / '.b.dat.1.1.tmp').touch()
+        self.assertEqual(['a'], list(stash.keys()))
+        self.assertEqual(1, stash.load('a'))
+        stash.dump('.cfg', 2)
+        self.assertEqual({'a', '.cfg'}, set(stash.keys()))
+        stash.clear()
+        self.assertEqual(0, len(tuple((self.path / 'data').iterdir())))
+
+
+class FailingWorker(object):
+    def __init__(self, n, fail_at=None):
+        self.n = n
+        self.fail_at = fail_at
+        self.generated = []
+
+    def __call__(self):
+        return self.generate(0)
+
+    def generate(self, start: int):
+        for i in range(start, self.n):
+            if i == self.fail_at:
+                raise ValueError(f'failed at {i}')
+            self.generated.append(i)
+            yield (str(i), i)
+
+
+class StartingWorker(FailingWorker):
+    def __call__(self, start: int = 0):
+        return self.generate(start)
+
+
+class TestOneShotFactoryStash(unittest.TestCase):
+    def setUp(self):
+        self.path = Path('target/oneshot-test')
+        if self.path.exists():
+            shutil.rmtree(self.path)
+
+    def test_batch(self):
+        stash = OneShotFactoryStash(FailingWorker(10), DictionaryStash(),
+                                    chunk_size=3, n_workers=2)
+        self.assertEqual(set(map(str, range(10))), set(stash.keys()))
+        self.assertEqual(4, stash.load('4'))
+
+    def test_resume(self):
+        progress_path = self.path / 'progress.json'
+        ds = DictionaryStash()
+        worker = FailingWorker(10, fail_at=7)
+        stash = OneShotFactoryStash(worker, ds, chunk_size=3,
+                                    progress_path=progress_path)
+        with self.assertRaises(ValueError):
+            stash.prime()
+        self.assertEqual(6, len(ds))
+        self.assertFalse(stash.has_data)
+        worker = FailingWorker(10)
+        stash = OneShotFactoryStash(worker, ds, chunk_size=3,
+                                    progress_path=progress_path)
+        self.assertFalse(stash.has_data)
+        self.assertEqual(10, len(stash))
+        self.assertTrue(stash.has_data)
+        # the worker regenerates the items it can't skip
+        self.assertEqual(list(range(10)), worker.generated)
+        self.assertEqual(10, len(ds))
+        with open(progress_path) as f:
+            self.assertEqual({'n_items': 10, 'complete': True}, json.load(f))
+        stash.clear()
+        self.assertFalse(progress_path.exists())
+        self.assertEqual(0, len(ds))
+
+    def test_resume_start(self):
+        progress_path = self.path / 'progress.json'
+        ds = DictionaryStash()
+        worker = StartingWorker(10, fail_at=7)
+        stash = OneShotFactoryStash(worker, ds, chunk_size=3,
+                                    progress_path=progress_path)
+        with self.assertRaises(ValueError):
+            stash.prime()
+        self.assertEqual(list(range(7)), worker.generated)
+        worker = StartingWorker(10)
+        stash = OneShotFactoryStash(worker, ds, chunk_size=3,
+                                    progress_path=progress_path)
+        self.assertEqual(10, len(stash))
+        # only the items after the last recorded batch are generated
+        self.assertEqual(list(range(6, 10)), worker.generated)
+        self.assertEqual(set(map(str, range(10))), set(ds.keys()))
+
+
+class CountKeysStash(DictionaryStash):
+    def __init__(self):
+        super(CountKeysStash, self).__init__()
+        self.n_keys = 0
+
+    def keys(self):
+        self.n_keys += 1
+        return super(CountKeysStash, self).keys()
+
+    def delete(self, name=None):
+        if name is None:
+            self.data.clear()
+        else:
+            super(CountKeysStash, self).delete(name)
+
+
+class CountKeysDirectoryStash(DirectoryStash):
+    def __init__(self, *args, **kwargs):
+        super(CountKeysDirectoryStash, self).__init__(*args, **kwargs)
+        self.n_keys = 0
+
+    def keys(self):
+        self.n_keys += 1
+        return super(CountKeysDirectoryStash, self).keys()
+
+
+class TestOrderedKeyStash(unittest.TestCase):
+    def test_index(self):
+        ds = CountKeysStash()
+        for i in (5, 1, 10, 3):
+            ds.dump(str(i), i)
+        stash = OrderedKeyStash(ds)
+        self.assertEqual(('1', '3', '5', '10'), stash.keys())
+        stash.dump('4', 4)
+        stash.dump('20', 20)
+        stash.dump('4', 40)
+        stash.delete('3')
+        self.assertEqual(('1', '4', '5', '10', '20'), stash.keys())
+        self.assertEqual(5, len(stash))
+        self.assertEqual(1, ds.n_keys)
+        self.assertEqual(('4', '5', '10'), stash.keys_between('2', '10'))
+        self.assertEqual(('5', '10'), stash.keys_between('4', offset=1,
+                                                         limit=2))
+        self.assertEqual(('1', '4'), stash.keys_between(limit=2))
+        self.assertEqual((), stash.keys_between('30'))
+        ds.dump('2', 2)
+        stash.invalidate()
+        self.assertEqual(('1', '2', '4', '5', '10', '20'), stash.keys())
+        self.assertEqual(2, ds.n_keys)
+        stash.delete()
+        self.assertEqual((), stash.keys())
+        stash.dump('7', 7)
+        self.assertEqual(('7',), stash.keys())
+
+    def test_directory_change(self):
+        path = Path('target/ordered-test')
+        if path.exists():
+            shutil.rmtree(path)
+        dstash = DirectoryStash(path)
+        stash = OrderedKeyStash(dstash)
+        stash.dump('2', 2)
+        stash.dump('1', 1)
+        self.assertEqual(('1', '2'), stash.keys())
+        tm.sleep(0.01)
+        dstash.dump('0', 0)
+        self.assertEqual(('0', '1', '2'), stash.keys())
+        dstash = CountKeysDirectoryStash(path)
+        stash = OrderedKeyStash(dstash)
+        self.assertEqual(('0', '1', '2'), stash.keys())
+        for i in range(5):
+            tm.sleep(0.01)
+            stash.dump('2', i)
+        self.assertEqual(('0', '1', '2'), stash.keys())
+        self.assertEqual(1, dstash.n_keys)
@@ -1,6 +1,7 @@
 import logging
 import unittest
 from pathlib import Path
+from io import StringIO
 import shutil
 from zensols.actioncli import (
     Config,
@@ -8,6 +9,9 @@ from zensols.actioncli import (
     StashFactory,
     DirectoryStash,
     FactoryStash,
+    ShardedStash,
+    InstrumentedStash,
+    ConcurrentStash,
 )
 
 #logging.basicConfig(level=logging.DEBUG)
@@ -54,3 +58,44 @@ class TestStashFactory(unittest.TestCase):
         self.assertTrue(self.target_path.is_dir())
         inst.prefix = 'pf'
         self.assertEqual(set(map(lambda x: (str(x), f'{x}'), range(5))), set(inst))
+
+    def test_sharded_create(self):
+        fac = StashFactory(self.conf)
+        inst = fac.instance('sharded')
+        self.assertTrue(isinstance(inst, ShardedStash))
+        self.assertEqual(2, len(inst.delegates))
+        for i in range(10):
+            inst.dump(str(i), i)
+        self.assertEqual(set(map(str, range(10))), set(inst.keys()))
+        self.assertTrue(Path('target/shard0').is_dir())
+        self.assertTrue(Path('target/shard1').is_dir())
+
+    def test_concurrent(self):
+        fac = StashFactory(self.conf)
+        inst = fac.instance('concurrent')
+        self.assertTrue(isinstance(inst, ConcurrentStash))
+        self.assertTrue(isinstance(inst.delegate, FactoryStash))
+        self.assertEqual('3', inst['3'])
+        self.assertEqual(('3',), tuple(inst.delegate.delegate.keys()))
+
+    def test_instrument(self):
+        fac = StashFactory(self.conf, instrument=True)
+        inst = fac.instance('range2')
+        self.assertTrue(isinstance(inst, InstrumentedStash))
+        self.assertTrue(isinstance(inst.delegate, FactoryStash))
+        self.assertEqual(set(map(lambda x: (str(x), str(x)), range(5))),
+                         set(inst))
+        self.assertEqual(5, inst.stats['load'].count)
+        self.assertEqual(0., inst.stats['exists'].hit_rate)
+        self.assertEqual(5, inst.stats['dump'].count)
+        dir_stash = inst.delegate.delegate
+        self.assertTrue(isinstance(dir_stash, InstrumentedStash))
+        self.assertEqual(0., dir_stash.stats['load'].hit_rate)
+        self.assertEqual(5, dir_stash.stats['dump'].count)
+        self.assertTrue(dir_stash.stats['dump'].bytes > 0)
+        sio = StringIO()
+        inst.write(sio)
+        report = sio.getvalue()
+        self.assertTrue(report.startswith('range2 (FactoryStash):'))
+        self.assertTrue('  dir1 (DirectoryStash):' in report)
+        self.assertTrue('  range1 (RangeStash1):' in report)